@@ -0,0 +1,107 @@
+"""Helper functions, shared by the database classes, for copying
+sqlite databases and for writing them to and reading them from files.
+
+"""
+
+import sqlite3
+
+
+def copy_db(src, dest, pages=-1, progress=None):
+    """Copy the entire contents of one sqlite database into another.
+
+    Arguments:
+      src (sqlite3.Connection): the source database.
+      dest (sqlite3.Connection): the destination database.  Any
+        existing content is replaced.
+      pages (int): the number of pages to copy per step; the default
+        (-1) copies the whole database in a single step.
+      progress (callable): if not None, this is called after each
+        step with arguments (status, remaining, total); see the
+        documentation of sqlite3.Connection.backup.
+
+    This uses the sqlite backup API, which copies database pages
+    rather than generating and re-parsing SQL.  The backup cannot
+    proceed while src has an open transaction, though, so in that case
+    the copy falls back to replaying src.iterdump() (which includes
+    the uncommitted changes, and leaves the transaction open).
+
+    """
+    if src.in_transaction:
+        dest.executescript(' '.join(src.iterdump()))
+        return
+    src.backup(dest, pages=pages, progress=progress)
+
+
+def write_dump(conn, fout, batch_size=10000):
+    """Write an SQL text dump of a database to an open file.
+
+    Arguments:
+      conn (sqlite3.Connection): the database to dump.
+      fout: a file opened for writing text.
+      batch_size (int): the number of lines (statements) of the
+        conn.iterdump() output to buffer before each write.
+
+    Each statement is written on its own line.
+
+    """
+    lines = []
+    for line in conn.iterdump():
+        lines.append(line)
+        if len(lines) >= batch_size:
+            fout.write('\n'.join(lines) + '\n')
+            lines = []
+    if len(lines):
+        fout.write('\n'.join(lines) + '\n')
+
+
+def iter_statements(fin, chunk_size=2**20):
+    """Read SQL statements from an open text file, and yield them one at
+    a time.  The file is read chunk_size characters at a time, so the
+    full text is never held in memory.  Statements are recognized
+    using sqlite3.complete_statement, and need not be separated by
+    newlines.
+
+    """
+    buf = ''
+    while True:
+        chunk = fin.read(chunk_size)
+        if not chunk:
+            break
+        buf += chunk
+        start = 0
+        end = buf.find(';')
+        while end >= 0:
+            if sqlite3.complete_statement(buf[start:end + 1]):
+                yield buf[start:end + 1].strip()
+                start = end + 1
+            end = buf.find(';', end + 1)
+        buf = buf[start:]
+    if buf.strip():
+        # Let sqlite complain about it.
+        yield buf.strip()
+
+
+def restore_dump(conn, fin, batch_size=10000):
+    """Execute the SQL statements in an open text file (such as one
+    created by write_dump) on a database.
+
+    Arguments:
+      conn (sqlite3.Connection): the destination database.
+      fin: a file opened for reading text.
+      batch_size (int): the number of statements to apply in each
+        transaction.
+
+    The BEGIN TRANSACTION and COMMIT statements in the dump are
+    dropped, in favor of the batched transactions.
+
+    """
+    batch = []
+    for statement in iter_statements(fin):
+        if statement.upper() in ['BEGIN TRANSACTION;', 'COMMIT;']:
+            continue
+        batch.append(statement)
+        if len(batch) >= batch_size:
+            conn.executescript('BEGIN;\n' + '\n'.join(batch) + '\nCOMMIT;')
+            batch = []
+    if len(batch):
+        conn.executescript('BEGIN;\n' + '\n'.join(batch) + '\nCOMMIT;')
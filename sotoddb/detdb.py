@@ -2,7 +2,10 @@ import sqlite3
 import gzip
 import os
 
-from .resultset import ResultSet
+import numpy as np
+
+from .resultset import ResultSet, table_dtypes
+from . import dbio
 
 
 class SchemaError(Exception):
@@ -147,7 +150,8 @@ class DetDB(object):
                 else:
                     last_id, last_t1 = _id, _t1
 
-    def create_table(self, table_name, column_defs, raw=False, commit=True):
+    def create_table(self, table_name, column_defs, raw=False, commit=True,
+                     index_props=[]):
         """Add a property table to the database.
 
         Args:
@@ -156,6 +160,8 @@ class DetDB(object):
             strings.
           raw (bool): See below.
           commit (bool): Whether to commit the changes to the db.
+          index_props (list): Names of property columns that should
+            be indexed (only valid if raw=False).
 
         The special columns `det`, `time0` and `time1` will be
         pre-pended unless raw=True.  An example of column_defs is::
@@ -165,6 +171,10 @@ class DetDB(object):
             "`y_pos` float",
           ]
 
+        Unless raw=True, an index is also created on (det_id, time0,
+        time1), to speed up the joins and time restrictions performed
+        by dets() and props().
+
         """
         c = self.conn.cursor()
         pre_cols = self.TABLE_TEMPLATE
@@ -173,17 +183,93 @@ class DetDB(object):
         q = ('create table if not exists `%s` (' % table_name +
              ','.join(pre_cols + column_defs) + ')')
         c.execute(q)
+        if not raw:
+            self.create_index(table_name, SPECIAL_COLS, commit=False)
+            for col in index_props:
+                self.create_index(table_name, [col], commit=False)
         if commit:
             self.conn.commit()
         return self
 
-    def copy(self, map_file=None, overwrite=False):
+    def create_index(self, table_name, columns, commit=True):
+        """Create an index on the specified columns of a table, if such an
+        index does not already exist.
+
+        Args:
+          table_name (str): The table name.
+          columns (list): The names of the columns to index.
+          commit (bool): Whether to commit the changes to the db.
+
+        Returns the name of the index, which is constructed from the
+        table and column names.
+
+        """
+        index_name = '_'.join(['idx', table_name] + list(columns))
+        self.conn.execute(
+            'create index if not exists `%s` on `%s` (%s)' %
+            (index_name, table_name,
+             ','.join(['`%s`' % col for col in columns])))
+        if commit:
+            self.conn.commit()
+        return index_name
+
+    def ensure_indexes(self, props=[], commit=True):
+        """Create any missing indexes that DetDB relies on.  This is only
+        needed for databases created by older versions of the code;
+        create_table sets up the indexes on new property tables.
+
+        Args:
+          props (list): Additional property columns to index, in
+            the form 'table.column' (the table defaults to 'base').
+          commit (bool): Whether to commit the changes to the db.
+
+        An index is created on the name column of the dets table
+        (unless it is already indexed, e.g. by a unique constraint),
+        and on (det_id, time0, time1) of each property table.
+
+        """
+        indexed = set()
+        for idx in self.conn.execute('PRAGMA index_list(dets)'):
+            cols = [r[2] for r in self.conn.execute(
+                'PRAGMA index_info(`%s`)' % idx[1])]
+            indexed.add(cols[0])
+        if 'name' not in indexed:
+            self.create_index('dets', ['name'], commit=False)
+        for t in self._get_property_tables():
+            self.create_index(t, SPECIAL_COLS, commit=False)
+        for p in props:
+            if '.' in p:
+                t, p = p.split('.', 1)
+            else:
+                t = 'base'
+            self.create_index(t, [p], commit=False)
+        if commit:
+            self.conn.commit()
+
+    def explain(self, query, args=()):
+        """Returns the plan that sqlite would use to execute the query
+        (with parameters args), as a list of strings.  This can be
+        used to confirm that indexes are being used.  For example::
+
+          >>> db.explain(*db.get_dets_query(props={'base.band': 'f090'}))
+          ['SCAN base', 'SEARCH dets USING INTEGER PRIMARY KEY (rowid=?)',
+           'USE TEMP B-TREE FOR GROUP BY']
+
+        """
+        c = self.conn.execute('EXPLAIN QUERY PLAN ' + query, tuple(args))
+        return [r[-1] for r in c]
+
+    def copy(self, map_file=None, overwrite=False, pages=-1, progress=None):
         """
         Duplicate the current database into a new database object, and
         return it.  If map_file is specified, the new database will be
         connected to that sqlite file on disk.  Note that a quick way
         of writing a DB to disk to call copy(map_file=...) and then
         simply discard the returned object.
+
+        The pages and progress arguments are passed to
+        dbio.copy_db, and may be used to copy the data in steps and
+        monitor progress.
         """
         if map_file is not None and os.path.exists(map_file):
             if overwrite:
@@ -192,8 +278,8 @@ class DetDB(object):
                 raise RuntimeError("Output file %s exists (overwrite=True "
                                    "to overwrite)." % map_file)
         new_db = DetDB(map_file=map_file, init_db=False)
-        script = ' '.join(self.conn.iterdump())
-        new_db.conn.executescript(script)
+        dbio.copy_db(self.conn, new_db.conn, pages=pages,
+                     progress=progress)
         return new_db
 
     def to_file(self, filename, overwrite=True, fmt=None):
@@ -219,12 +305,10 @@ class DetDB(object):
             self.copy(map_file=filename, overwrite=overwrite)
         elif fmt == 'dump':
             with open(filename, 'w') as fout:
-                for line in self.conn.iterdump():
-                    fout.write(line)
+                dbio.write_dump(self.conn, fout)
         elif fmt == 'gz':
-            with gzip.GzipFile(filename, 'wb') as fout:
-                for line in self.conn.iterdump():
-                    fout.write(line.encode('utf-8'))
+            with gzip.open(filename, 'wt', encoding='utf-8') as fout:
+                dbio.write_dump(self.conn, fout)
         else:
             raise RuntimeError(f'Unknown format "{fmt}" requested.')
 
@@ -249,16 +333,15 @@ class DetDB(object):
         if fmt == 'sqlite':
             db0 = cls(map_file=filename)
             return db0.copy(map_file=None)
-        elif fmt == 'dump':
-            with open(filename, 'r') as fin:
-                data = fin.read()
-        elif fmt == 'gz':
-            with gzip.GzipFile(filename, 'r') as fin:
-                data = fin.read().decode('utf-8')
-        else:
+        elif fmt not in ['dump', 'gz']:
             raise RuntimeError(f'Unknown format "{fmt}" requested.')
         new_db = DetDB(map_file=None, init_db=False)
-        new_db.conn.executescript(data)
+        if fmt == 'dump':
+            with open(filename, 'r') as fin:
+                dbio.restore_dump(new_db.conn, fin)
+        else:
+            with gzip.open(filename, 'rt', encoding='utf-8') as fin:
+                dbio.restore_dump(new_db.conn, fin)
         return new_db
 
     def reduce(self, dets=None, time0=None, time1=None,
@@ -372,6 +455,105 @@ class DetDB(object):
         if commit:
             self.conn.commit()
 
+    def add_props_bulk(self, table_, data, time_range=None,
+                       check_intervals=False, commit=True):
+        """Add property information for many detectors at once.
+
+        Args:
+          table_ (str): The property table name.
+          data: The data to add, as a ResultSet, a structured numpy
+            array, or a dict of columns.  There must be a 'name'
+            column with the detector names.  If there are 'time0' and
+            'time1' columns, they give the time range of each row.
+            All other columns are written to the property table.
+          time_range (pair of ints): The time range over which the
+            property values are applicable, if data does not have
+            time0 and time1 columns.
+          check_intervals (bool): If True, check that the new rows
+            have valid time intervals that do not overlap with each
+            other or with the rows already in the table.  An
+            IntervalError is raised (before anything is written) if
+            the check fails.
+          commit (bool): Whether or not to commit the db.
+
+        Detectors not already in the dets table are added to it, in
+        the order in which they first appear in data.
+
+        """
+        if isinstance(data, ResultSet):
+            data = data.columns
+        elif isinstance(data, np.ndarray):
+            data = {k: data[k] for k in data.dtype.names}
+        data = {k: np.asarray(v) for k, v in data.items()}
+        names = data.pop('name')
+        n = len(names)
+        if 'time0' in data or 'time1' in data:
+            time0, time1 = data.pop('time0'), data.pop('time1')
+        else:
+            if time_range is None:
+                time_range = self.ALWAYS
+            time0 = np.full(n, time_range[0])
+            time1 = np.full(n, time_range[1])
+
+        # Distinct names, in order of first appearance.
+        uniq, first, inverse = np.unique(
+            names, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        uniq = uniq[order]
+        inverse = np.argsort(order)[inverse]
+        uniq = uniq.tolist()
+
+        c = self.conn.cursor()
+        c.execute('drop table if exists _bulk_names')
+        c.execute('create temp table _bulk_names (`name` varchar(256))')
+        c.executemany('insert into _bulk_names (name) values (?)',
+                      [(x,) for x in uniq])
+
+        if check_intervals:
+            # Existing intervals, for dets that are already known.
+            c.execute(f'select _bulk_names.rowid - 1, time0, time1 '
+                      f'from _bulk_names join dets on '
+                      f'_bulk_names.name=dets.name join `{table_}` '
+                      f'on `{table_}`.det_id=dets.id')
+            old = np.array(c.fetchall(), dtype=float).reshape(-1, 3)
+            idx = np.concatenate([old[:, 0], inverse])
+            t0 = np.concatenate([old[:, 1], time0])
+            t1 = np.concatenate([old[:, 2], time1])
+            bad = (t1 < t0)
+            if np.any(bad):
+                i = bad.nonzero()[0][0]
+                c.execute('drop table _bulk_names')
+                raise IntervalError(
+                    "Negative size time interval for table %s, "
+                    "det=%s" % (table_, uniq[int(idx[i])]))
+            s = np.lexsort([t0, idx])
+            bad = (idx[s][1:] == idx[s][:-1]) & (t0[s][1:] < t1[s][:-1])
+            if np.any(bad):
+                i = s[bad.nonzero()[0][0]]
+                c.execute('drop table _bulk_names')
+                raise IntervalError(
+                    "Overlapping interval for table %s, "
+                    "det=%s" % (table_, uniq[int(idx[i])]))
+
+        # Create any new dets, then get the det_id of each row.
+        c.execute('insert or ignore into dets (name) '
+                  'select name from _bulk_names order by rowid')
+        c.execute('select dets.id from _bulk_names join dets on '
+                  '_bulk_names.name=dets.name order by _bulk_names.rowid')
+        det_ids = np.array([r[0] for r in c])[inverse]
+        c.execute('drop table _bulk_names')
+
+        keys = list(data.keys())
+        key_string = ','.join(['det_id', 'time0', 'time1'] +
+                              ['`{}`'.format(k) for k in keys])
+        val_string = ','.join(['?'] * (len(keys) + 3))
+        columns = [det_ids, time0, time1] + [data[k] for k in keys]
+        c.executemany(f'insert into `{table_}` ({key_string}) '
+                      f'values ({val_string})',
+                      zip(*[col.tolist() for col in columns]))
+        if commit:
+            self.conn.commit()
+
     # Forward lookup.
     def dets(self, timestamp=None, props={}):
         """
@@ -380,6 +562,17 @@ class DetDB(object):
         restriction is not applied.
 
         Returns a list of detector names.
+        """
+        q, args = self.get_dets_query(timestamp, props)
+        c = self.conn.cursor()
+        c.execute(q, args)
+        return ResultSet.from_cursor(
+            c, dtypes=table_dtypes(self.conn, 'dets'))
+
+    def get_dets_query(self, timestamp=None, props={}):
+        """Returns the query string and the tuple of query parameters that
+        would be used to evaluate dets(timestamp, props).
+
         """
         # Accumulate a query, and args.
         q = 'select dets.name as name from dets'
@@ -436,9 +629,7 @@ class DetDB(object):
         if (restricts):
             q += ' where ' + ' and '.join(restricts)
         q = q + ' group by id'
-        c = self.conn.cursor()
-        c.execute(q, tuple(args))
-        return ResultSet.from_cursor(c)
+        return q, tuple(args)
 
     # Reverse lookup.
     def props(self, dets=None, timestamp=None, props=None,
@@ -446,7 +637,12 @@ class DetDB(object):
         """
         Get the value of the properties listed in props, for each detector
         identified in dets (a list of strings, or a ResultSet with a
-        column called 'name').
+        column called 'name').  If timestamp is not None, then only
+        property rows whose time range includes the timestamp are
+        returned.
+
+        To look up the properties of many detectors at many
+        timestamps, see snapshot().
         """
         # Create temporary table
         c = self.conn.cursor()
@@ -466,41 +662,67 @@ class DetDB(object):
             c.execute(q, (a,))
         c.execute('end transaction')
 
-        # Expand props argument.
-        if props is None:
-            props = [t + '.' for t in self._get_property_tables()]
-
-        props, props_ = [], props
-        for p in props_:
-            if p.endswith('.'):
-                table_p = self._get_property_list(p[:-1])
-                props.extend([p + _p for _p in table_p])
-            else:
-                props.append(p)
-
         # Now look stuff up in it.
         other_tables = []
-        fields, keys = [], []
-        for i, m in enumerate(props):
-            if '.' in m:
-                t, f = m.split('.', 1)
-            else:
-                t, f = 'base', m
+        fields, keys, dtypes = [], [], []
+        for i, (t, f) in enumerate(self._expand_props(props)):
             if t not in other_tables:
                 other_tables.append(t)
             key = f'{t}.{f}'
             keys.append(key)
             fields.append(f'{key} as result{i}')
+            dtypes.append(table_dtypes(self.conn, t).get(f))
         q = ('select ' + ', '.join(fields) +
              ' from _dets join dets on _dets.name=dets.name ' +
              ' '.join(['join %s on %s.det_id=dets.id' % (m, m)
                        for m in other_tables]))
-        c.execute(q)
-        results = ResultSet.from_cursor(c, keys=keys)
+        args = []
+        if timestamp is not None:
+            q += ' where ' + ' and '.join(
+                ['%s.time0 <= ? and ? < %s.time1' % (m, m)
+                 for m in other_tables])
+            args = [timestamp] * (2 * len(other_tables))
+        c.execute(q, args)
+        results = ResultSet.from_cursor(c, keys=keys, dtypes=dtypes)
         c.execute('drop table if exists _dets')
         results.strip(['base.'])
         return results
 
+    def _expand_props(self, props=None):
+        """Decode a list of property names, as passed to props(), into a
+        list of (table, column) pairs.  Entries of the form 'table.'
+        are expanded to include all columns of the table; entries
+        without a table name refer to the 'base' table.  If props is
+        None, all columns of all property tables are included.
+
+        """
+        if props is None:
+            props = [t + '.' for t in self._get_property_tables()]
+        output = []
+        for p in props:
+            if p.endswith('.'):
+                output.extend([(p[:-1], _p) for _p in
+                               self._get_property_list(p[:-1])])
+            elif '.' in p:
+                output.append(tuple(p.split('.', 1)))
+            else:
+                output.append(('base', p))
+        return output
+
+    def snapshot(self, props=None):
+        """Load the specified properties into memory, for fast lookup of
+        the properties of many detectors at many times.
+
+        Args:
+          props (list): the properties to load, in the format
+            accepted by props().  Defaults to all properties.
+
+        Returns a PropsSnapshot.  This is independent of the DetDB,
+        and will not reflect subsequent changes to it.
+
+        """
+        return PropsSnapshot(self, props)
+
     def intersect(self, *specs, resolve=False):
         """Intersect the provided detector specs.  Each entry is either a list
         (or similar iterable) of detector names, or a dictionary
@@ -536,6 +758,125 @@ class DetDB(object):
         return [n for n in req if n in keepers]
 
 
+class PropsSnapshot:
+    """In-memory copy of some DetDB properties, organized for vectorized
+    lookup of the properties of many detectors at many times.  Create
+    this using DetDB.snapshot().
+
+    For each property table, the rows are sorted by detector and then
+    by time0; the row (if any) that applies to a given detector at a
+    given time is found with a binary search.  This relies on the
+    rows for each det_id not having overlapping time intervals (see
+    DetDB.validate).
+
+    """
+    def __init__(self, detdb, props=None):
+        pairs = detdb._expand_props(props)
+        self.keys = ['%s.%s' % p for p in pairs]
+        tables = []
+        for t, f in pairs:
+            if t not in tables:
+                tables.append(t)
+
+        #: Sorted array of all detector names.
+        self.names = np.array(sorted(
+            [r[0] for r in detdb.conn.execute('select name from dets')]),
+                              dtype=str)
+
+        #: Dict mapping each table name to a dict of columns:
+        #: 'key' (the det index and time0 rank, combined), 'time1',
+        #: and the property columns.
+        self.tables = {}
+        #: Dict mapping each table name to the sorted unique time0.
+        self.time0 = {}
+        for t in tables:
+            fields = [f for _t, f in pairs if _t == t]
+            c = detdb.conn.execute(
+                'select dets.name, `%s`.time0, `%s`.time1, %s from `%s` '
+                'join dets on `%s`.det_id=dets.id' %
+                (t, t, ','.join(['`%s`.`%s`' % (t, f) for f in fields]),
+                 t, t))
+            rs = ResultSet.from_cursor(c, keys=['name', 'time0', 'time1']
+                                       + fields)
+            det_idx = np.searchsorted(self.names,
+                                      rs['name'].astype(str))
+            time0 = rs['time0'].astype(float)
+            uniq_t0, rank = np.unique(time0, return_inverse=True)
+            key = det_idx * (len(uniq_t0) + 1) + rank
+            # Among rows with the same time0, put empty intervals
+            # first, so the lookup lands on the row that can match.
+            time1 = rs['time1'].astype(float)
+            order = np.lexsort([time1, key])
+            table = {k: rs[k][order] for k in fields}
+            table['key'] = key[order]
+            table['time1'] = time1[order]
+            self.tables[t] = table
+            self.time0[t] = uniq_t0
+
+    def props(self, dets=None, timestamps=None):
+        """Get the value of the snapshot properties, for each detector in
+        dets at each time in timestamps.
+
+        Args:
+          dets: a list of detector names, or a ResultSet with a
+            column called 'name'.  Defaults to all detectors.
+          timestamps: a single timestamp or an array of them.  This
+            must be specified.
+
+        Returns a ResultSet with columns 'name', 'timestamp', and the
+        properties (with the prefix 'base.' removed, as in
+        DetDB.props).  There is one row for each (det, timestamp)
+        pair at which all the properties are defined; the rows are
+        ordered by det and then by timestamp.
+
+        """
+        if timestamps is None:
+            raise ValueError('PropsSnapshot.props requires timestamps.')
+        if dets is None:
+            dets = self.names
+        elif isinstance(dets, ResultSet):
+            dets = dets['name']
+        dets = np.asarray(dets)
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=float))
+
+        # Drop dets that are not in the db.
+        det_idx = np.searchsorted(self.names, dets)
+        known = (det_idx < len(self.names))
+        known[known] = (self.names[det_idx[known]] == dets[known])
+        dets, det_idx = dets[known], det_idx[known]
+
+        # All (det, timestamp) pairs.
+        n_t = len(timestamps)
+        det_i = np.repeat(np.arange(len(dets)), n_t)
+        t = np.tile(timestamps, len(dets))
+        valid = np.ones(len(t), bool)
+        rows = {}
+        for table_name, table in self.tables.items():
+            uniq_t0 = self.time0[table_name]
+            # Key of the first row that starts after t, for this det;
+            # the row before that is the only candidate.
+            qkey = (det_idx[det_i] * (len(uniq_t0) + 1) +
+                    np.searchsorted(uniq_t0, t, side='right'))
+            row = np.searchsorted(table['key'], qkey) - 1
+            ok = (row >= 0)
+            row[~ok] = 0
+            if len(table['key']):
+                ok &= (table['key'][row] // (len(uniq_t0) + 1)
+                       == det_idx[det_i])
+                ok &= (t < table['time1'][row])
+            valid &= ok
+            rows[table_name] = row
+
+        columns = [dets[det_i[valid]], t[valid]]
+        for k in self.keys:
+            table_name, f = k.split('.', 1)
+            columns.append(self.tables[table_name][f][rows[table_name][valid]])
+        output = ResultSet.from_columns(columns,
+                                        keys=['name', 'timestamp'] + self.keys)
+        output.strip(['base.'])
+        return output
+
+
 def get_example():
     """
     Returns an example DetDB, mapped to RAM, for the SO LAT-like
@@ -569,7 +910,9 @@ def get_example():
     tel_info = {'instrument': 'simonsobs',
                 'camera': 'latr'}
 
-    det_names = []
+    base = {k: [] for k in ['name', 'det_type', 'instrument', 'camera',
+                            'freq_code', 'array_class', 'array_code',
+                            'wafer_code']}
     for ar_type, bands, n_ar, n_wa, n_det in [
             ('LF', [27, 39], 1, 3, 37),
             ('MF', [93, 145], 4, 3, 432),
@@ -583,28 +926,25 @@ def get_example():
                     info = {'freq_code': 'f%03i' % f,
                             'array_class': ar_type,
                             'array_code': '%s%i' % (ar_type, ar+1),
-                            'wafer_code': 'W%i' % (wa+1)}
+                            'wafer_code': 'W%i' % (wa+1),
+                            'det_type': 'bolo'}
+                    info.update(tel_info)
                     for i in range(iofs, iofs + n_det):
-                        det_names.append('%s%i_%05i' % (ar_type, ar+1, i))
-                        db.add_props('base', det_names[-1],
-                                     det_type='bolo',
-                                     **tel_info, **info, commit=False)
+                        base['name'].append('%s%i_%05i' % (ar_type, ar+1, i))
+                        for k, v in info.items():
+                            base[k].append(v)
 
+    det_names = base['name']
     print('Committing {} detectors...'.format(len(det_names)))
-    db.conn.commit()
+    db.add_props_bulk('base', base)
 
     # Organize these dets in a big square.  This is not the plan.
     n_row = int(len(det_names)**.5 + 1)
-    for i in range(n_row):
-        for j in range(n_row):
-            d = i*n_row+j
-            if d >= len(det_names):
-                break
-            x, y, ang = i * .02, j * .02, (i+j) % 12. * 15
-            db.add_props('geometry', det_names[d], commit=False,
-                         wafer_x=x, wafer_y=y, wafer_pol=ang)
-
-    db.conn.commit()
+    i, j = np.divmod(np.arange(len(det_names)), n_row)
+    db.add_props_bulk('geometry', {'name': det_names,
+                                   'wafer_x': i * .02,
+                                   'wafer_y': j * .02,
+                                   'wafer_pol': (i+j) % 12. * 15})
 
     print('Checking the work...')
     db.validate()
@@ -1,14 +1,29 @@
 from sotodlib import core
+from .proddb import ManifestDB
 from .simple import PerDetectorHdf5
 
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 REGISTRY = {
     'PerDetectorHdf5': PerDetectorHdf5.loader_class(),
 }
 
 class SuperLoader:
-    def __init__(self, context=None, detdb=None, obsdb=None):
+    #: The default number of threads to use for loading the index
+    #: lines of each spec.  None (or 1) loads them serially.
+    workers = None
+
+    #: The maximum number of opened ManifestDBs to keep for reuse.
+    #: Set this to 0 to disable the cache.
+    manifest_cache_size = 32
+
+    #: ManifestDB files up to this size (in bytes) are copied into
+    #: memory when opened.  Set this to 0 to use the files directly.
+    manifest_memory_limit = 0
+
+    def __init__(self, context=None, detdb=None, obsdb=None, workers=None):
         if context is not None:
             if detdb is None:
                 detdb = context.detdb
@@ -16,98 +31,290 @@ class SuperLoader:
                 obsdb = context.obsdb
         self.detdb = detdb
         self.obsdb = obsdb
+        if workers is not None:
+            self.workers = workers
+        self._manifests = OrderedDict()
+        self._manifest_stats = {'hits': 0, 'misses': 0}
 
     def load_raw(self, spec_list, request,
                  restrict_on_index=True,
-                 restrict_on_request=True):
+                 restrict_on_request=True,
+                 workers=None):
         """Loads metadata objects and returns them in their Natural
         containers.
 
+        If workers (or, if that is None, self.workers) is greater than
+        1, the index lines of each spec are loaded concurrently, using
+        a pool of that many threads.  The index lines are grouped by
+        filename, and each group is loaded serially by a single
+        thread.  The results are combined in the original order.
+
         """
+        if workers is None:
+            workers = self.workers
         items = []
         for spec_dict in spec_list:
-            dbfile = spec_dict['db']
-            dbfile_path = os.path.split(dbfile)[0]
-            names = spec_dict['name']
-            loader = spec_dict.get('loader', None)
-
-            # Load the database, match the request,
-            try:
-                from sotodlib import metadata
-                man = metadata.ManifestDB.from_file(dbfile)
-            except:
-                man = core.metadata.ManifestDb.from_file(dbfile)
-            # Provide any extrinsic boosting.
-            ### This is tricky.  Do you look up _everything_, if you
-            ### have an obsdb abd obs:obs_id is given?  Do you inspect
-            ### the scheme and only provide what is missing?  That is
-            ### possible.
-            missing_keys = man.scheme.get_required_params()
-            for k in request.keys():
-                if k in missing_keys:
-                    missing_keys.remove(k)
-            obs_keys = [k for k in missing_keys if k.startswith('obs:')]
-            if len(obs_keys):
-                assert(self.obsdb is not None)
-                assert('obs:obs_id' in request)
-                request.update(self.obsdb.get(request['obs:obs_id'],
-                                              add_prefix='obs:'))
+            man = self._open_manifest(spec_dict['db'])
+            self._augment_request(man, request)
             try:
                 index_lines = man.match(request, multi=True)
             except Exception as e:
-                # Catch any errors and provide a bunch of context to
-                # help user fix their config.
-                text = str(e)
-                raise RuntimeError(
-                    'An exception was raised while decoding the following spec:\n'
-                    + '  ' + str(spec_dict) + '\n'
-                    + 'with the following request:\n'
-                    + '  ' + str(request) + '\n'
-                    + 'The exception is:\n  %s' % text)
-
-            # Make files relative to db location.
-            for line in index_lines:
-                if 'filename' in line:
-                    line['filename'] = os.path.join(dbfile_path, line['filename'])
-
-            # Load and reduce each Index line
-            results = []
-            for index_line in index_lines:
-                # Augment the index_line with info from the request.
-                skip_this = False
-                for k in request:
-                    if k in index_line:
-                        if request[k] != index_line[k]:
-                            skip_this = True
-                if skip_this:
-                    continue
-                index_line.update(request)
-                if loader is None:
-                    # Pop?
-                    loader = index_line.get('loader')
-                if loader is None:
-                    loader = 'PerDetectorHdf5'
-                loader_class = REGISTRY[loader]
-                loader_object = loader_class(detdb=self.detdb, obsdb=self.obsdb)
-                mi1 = loader_object.from_loadspec(index_line)
-                # restrict to index_line...
-                mi2 = mi1.restrict_dets(index_line, detdb=self.detdb)
-                results.append(mi2)
-
-            # Check that we got results, then combine them in to single ResultSet.
-            assert(len(results) > 0)
-            result = results[0].concatenate(results)
-
-            # Get list of fields and decode name map.
-            if isinstance(result, core.AxisManager):
-                fields = list(result._fields.keys())
-            else:
-                fields = result.keys
-            unpackers = Unpacker.decode(names, fields)
+                raise self._match_error(spec_dict, request, e)
+            tasks = self._get_tasks(spec_dict, request, index_lines)
+            loaded = self._load_index_lines(tasks, workers)
+            items.append(self._combine(spec_dict, tasks, loaded))
+        return items
+
+    def load_many_raw(self, spec_list, requests, workers=None):
+        """Loads metadata objects for each of a list of requests.
+        Returns a list with one entry per request, each of which is a
+        list like the output of load_raw(spec_list, request).
+
+        Each ManifestDB is opened only once, all the requests are
+        matched together, and each file is read only once.  The
+        requests are matched in a single query if the ManifestDB
+        supports match_many, as sotoddb.proddb.ManifestDB does (see
+        _open_manifest); otherwise they are matched one at a time.  See
+        load_raw for the meaning of workers.  The requests are not
+        modified.
 
-            items.append((unpackers, result))
+        """
+        if workers is None:
+            workers = self.workers
+        requests = [dict(r) for r in requests]
+        items = [[] for r in requests]
+        for spec_dict in spec_list:
+            man = self._open_manifest(spec_dict['db'])
+            for request in requests:
+                self._augment_request(man, request)
+            try:
+                if hasattr(man, 'match_many'):
+                    all_lines = man.match_many(requests)
+                else:
+                    all_lines = [man.match(r, multi=True) for r in requests]
+            except Exception as e:
+                raise self._match_error(spec_dict, requests, e)
+
+            # Load all the index lines together, so each file is only
+            # read once.
+            all_tasks, bounds = [], [0]
+            for request, index_lines in zip(requests, all_lines):
+                all_tasks.extend(
+                    self._get_tasks(spec_dict, request, index_lines))
+                bounds.append(len(all_tasks))
+            all_loaded = self._load_index_lines(all_tasks, workers)
+
+            for i, request in enumerate(requests):
+                i0, i1 = bounds[i], bounds[i + 1]
+                try:
+                    items[i].append(self._combine(
+                        spec_dict, all_tasks[i0:i1], all_loaded[i0:i1]))
+                except Exception as e:
+                    self._add_context(e, spec_dict, request)
+                    raise e
         return items
 
+    def load_many(self, spec_list, requests, workers=None):
+        """Loads metadata for each of a list of requests, and returns a
+        list of AxisManagers (one per request).  The result for each
+        request contains the same metadata as load(spec_list,
+        request) would return.  This is equivalent to running
+        load_many_raw and then unpacking each item.
+
+        """
+        items = self.load_many_raw(spec_list, requests, workers=workers)
+        dests = []
+        for request, request_items in zip(requests, items):
+            dest = None
+            for spec, item in zip(spec_list, request_items):
+                try:
+                    dest = self.unpack([item], dest=dest)
+                except Exception as e:
+                    self._add_context(e, spec, request)
+                    raise e
+            dests.append(dest)
+        return dests
+
+    @staticmethod
+    def _add_context(e, spec, request):
+        """Add information about spec and request to the args of
+        exception e.
+
+        """
+        e.args = e.args + (
+            "\n\nThe above exception arose while processing "
+            "the following metadata spec:\n"
+            f"  spec:    {spec}\n"
+            f"  request: {request}\n\n"
+            "Does your database expose this product for this observation?",)
+
+    def _open_manifest(self, dbfile):
+        """Returns the ManifestDB stored in dbfile, opened as a
+        sotoddb.proddb.ManifestDB (or, if that fails, as a sotodlib
+        ManifestDb).  Opened ManifestDBs are cached (see
+        manifest_cache_size), keyed on the path, and reused until the
+        file's modification time or size changes.
+
+        """
+        path = os.path.abspath(dbfile)
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+        item = self._manifests.get(path)
+        if item is not None and item[0] == version:
+            self._manifest_stats['hits'] += 1
+            self._manifests.move_to_end(path)
+            return item[1]
+        self._manifest_stats['misses'] += 1
+        try:
+            # This supports match_many, for load_many.
+            man = ManifestDB.from_file(dbfile)
+        except Exception:
+            man = core.metadata.ManifestDb.from_file(dbfile)
+        if st.st_size <= self.manifest_memory_limit:
+            disk_man, man = man, man.copy()
+            disk_man.conn.close()
+        if self.manifest_cache_size > 0:
+            self._manifests[path] = (version, man)
+            while len(self._manifests) > self.manifest_cache_size:
+                self._manifests.popitem(last=False)
+        return man
+
+    def clear_cache(self):
+        """Discard all cached ManifestDBs (see manifest_cache_size)."""
+        self._manifests.clear()
+
+    def cache_info(self):
+        """Returns a dict with the number of 'hits' and 'misses' of the
+        ManifestDB cache, and its current 'size'.
+
+        """
+        return dict(self._manifest_stats, size=len(self._manifests))
+
+    def _augment_request(self, man, request):
+        """Provide any extrinsic boosting; request is updated in place
+        with any obs: keys required by man that can be looked up in
+        the ObsDB.
+
+        """
+        ### This is tricky.  Do you look up _everything_, if you
+        ### have an obsdb abd obs:obs_id is given?  Do you inspect
+        ### the scheme and only provide what is missing?  That is
+        ### possible.
+        missing_keys = man.scheme.get_required_params()
+        for k in request.keys():
+            if k in missing_keys:
+                missing_keys.remove(k)
+        obs_keys = [k for k in missing_keys if k.startswith('obs:')]
+        if len(obs_keys):
+            assert(self.obsdb is not None)
+            assert('obs:obs_id' in request)
+            request.update(self.obsdb.get(request['obs:obs_id'],
+                                          add_prefix='obs:'))
+
+    @staticmethod
+    def _match_error(spec_dict, request, e):
+        """Returns a RuntimeError describing an exception raised while
+        matching request against the ManifestDB of spec_dict.
+
+        """
+        # Provide a bunch of context to help user fix their config.
+        text = str(e)
+        return RuntimeError(
+            'An exception was raised while decoding the following spec:\n'
+            + '  ' + str(spec_dict) + '\n'
+            + 'with the following request:\n'
+            + '  ' + str(request) + '\n'
+            + 'The exception is:\n  %s' % text)
+
+    def _get_tasks(self, spec_dict, request, index_lines):
+        """Prepare the index_lines matched for request, for loading.
+        Returns a list of tuples (loader, index_line).
+
+        """
+        dbfile_path = os.path.split(spec_dict['db'])[0]
+        loader = spec_dict.get('loader', None)
+
+        # Make files relative to db location.
+        for line in index_lines:
+            if 'filename' in line:
+                line['filename'] = os.path.join(dbfile_path, line['filename'])
+
+        tasks = []
+        for index_line in index_lines:
+            # Augment the index_line with info from the request.
+            skip_this = False
+            for k in request:
+                if k in index_line:
+                    if request[k] != index_line[k]:
+                        skip_this = True
+            if skip_this:
+                continue
+            index_line.update(request)
+            if loader is None:
+                # Pop?
+                loader = index_line.get('loader')
+            if loader is None:
+                loader = 'PerDetectorHdf5'
+            tasks.append((loader, index_line))
+        return tasks
+
+    def _combine(self, spec_dict, tasks, loaded):
+        """Reduce each loaded object to its index line, and combine them.
+        Returns a tuple (unpackers, result), as in the load_raw
+        output.
+
+        """
+        results = []
+        for (_, index_line), mi1 in zip(tasks, loaded):
+            # restrict to index_line...
+            mi2 = mi1.restrict_dets(index_line, detdb=self.detdb)
+            results.append(mi2)
+
+        # Check that we got results, then combine them in to single ResultSet.
+        assert(len(results) > 0)
+        result = results[0].concatenate(results)
+
+        # Get list of fields and decode name map.
+        if isinstance(result, core.AxisManager):
+            fields = list(result._fields.keys())
+        else:
+            fields = result.keys
+        unpackers = Unpacker.decode(spec_dict['name'], fields)
+        return (unpackers, result)
+
+    def _load_index_lines(self, tasks, workers=None):
+        """Load the metadata for each item in tasks, which is a list of
+        tuples (loader, index_line).  Returns a list of the loaded
+        objects, in the same order as tasks.  The items are grouped
+        by filename, and the groups are loaded one at a time (or
+        concurrently; see load_raw for the meaning of workers).
+
+        """
+        def load_group(group):
+            output = []
+            for i in group:
+                loader, index_line = tasks[i]
+                loader_object = REGISTRY[loader](detdb=self.detdb,
+                                                 obsdb=self.obsdb)
+                output.append(loader_object.from_loadspec(index_line))
+            return output
+
+        groups = {}
+        for i, (_, index_line) in enumerate(tasks):
+            groups.setdefault(index_line.get('filename'), []).append(i)
+        groups = list(groups.values())
+        if workers is None or workers <= 1 or len(groups) <= 1:
+            outputs = list(map(load_group, groups))
+        else:
+            # Each file is opened by only one thread.
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                outputs = list(pool.map(load_group, groups))
+        loaded = [None] * len(tasks)
+        for group, output in zip(groups, outputs):
+            for i, item in zip(group, output):
+                loaded[i] = item
+        return loaded
+
     def unpack(self, packed_items, dest=None):
         """Unpack items from packed_items, and return then in a single
         AxisManager.
@@ -148,12 +355,7 @@ class SuperLoader:
                 item = self.load_raw([spec], request)
                 dest = self.unpack(item, dest=dest)
             except Exception as e:
-                e.args = e.args + (
-                    "\n\nThe above exception arose while processing "
-                    "the following metadata spec:\n"
-                    f"  spec:    {spec}\n"
-                    f"  request: {request}\n\n"
-                    "Does your database expose this product for this observation?",)
+                self._add_context(e, spec, request)
                 raise e
         return dest
 
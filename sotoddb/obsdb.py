@@ -2,7 +2,8 @@ import sqlite3
 import gzip
 import os
 
-from .resultset import ResultSet
+from .resultset import ResultSet, table_dtypes
+from . import dbio
 
 # Design of observation database... certainly the main table contains
 # basic incontrovertible facts.  Like an obs_id and a timestamp.  But
@@ -83,13 +84,17 @@ class ObsDB(object):
             self.conn.commit()
         return self
 
-    def copy(self, map_file=None, overwrite=False):
+    def copy(self, map_file=None, overwrite=False, pages=-1, progress=None):
         """
         Duplicate the current database into a new database object, and
         return it.  If map_file is specified, the new database will be
         connected to that sqlite file on disk.  Note that a quick way
         of writing a DB to disk to call copy(map_file=...) and then
         simply discard the returned object.
+
+        The pages and progress arguments are passed to
+        dbio.copy_db, and may be used to copy the data in steps and
+        monitor progress.
         """
         if map_file is not None and os.path.exists(map_file):
             if overwrite:
@@ -98,8 +103,8 @@ class ObsDB(object):
                 raise RuntimeError("Output file %s exists (overwrite=True "
                                    "to overwrite)." % map_file)
         new_db = ObsDB(map_file=map_file, init_db=False)
-        script = ' '.join(self.conn.iterdump())
-        new_db.conn.executescript(script)
+        dbio.copy_db(self.conn, new_db.conn, pages=pages,
+                     progress=progress)
         return new_db
 
     def to_file(self, filename, overwrite=True, fmt=None):
@@ -125,12 +130,10 @@ class ObsDB(object):
             self.copy(map_file=filename, overwrite=overwrite)
         elif fmt == 'dump':
             with open(filename, 'w') as fout:
-                for line in self.conn.iterdump():
-                    fout.write(line)
+                dbio.write_dump(self.conn, fout)
         elif fmt == 'gz':
-            with gzip.GzipFile(filename, 'wb') as fout:
-                for line in self.conn.iterdump():
-                    fout.write(line.encode('utf-8'))
+            with gzip.open(filename, 'wt', encoding='utf-8') as fout:
+                dbio.write_dump(self.conn, fout)
         else:
             raise RuntimeError(f'Unknown format "{fmt}" requested.')
 
@@ -155,16 +158,15 @@ class ObsDB(object):
         if fmt == 'sqlite':
             db0 = cls(map_file=filename)
             return db0.copy(map_file=None)
-        elif fmt == 'dump':
-            with open(filename, 'r') as fin:
-                data = fin.read()
-        elif fmt == 'gz':
-            with gzip.GzipFile(filename, 'r') as fin:
-                data = fin.read().decode('utf-8')
-        else:
+        elif fmt not in ['dump', 'gz']:
             raise RuntimeError(f'Unknown format "{fmt}" requested.')
         new_db = cls(map_file=None, init_db=False)
-        new_db.conn.executescript(data)
+        if fmt == 'dump':
+            with open(filename, 'r') as fin:
+                dbio.restore_dump(new_db.conn, fin)
+        else:
+            with gzip.open(filename, 'rt', encoding='utf-8') as fin:
+                dbio.restore_dump(new_db.conn, fin)
         return new_db
 
     def get(self, obs_id=None, add_prefix=''):
@@ -193,7 +195,8 @@ class ObsDB(object):
         assert(keys is None)  # Not implemented, sry.
         assert(tags is None)  # Not implemented, sry.
         c = self.conn.execute('select * from obs where %s' % query_text)
-        results = ResultSet.from_cursor(c)
+        results = ResultSet.from_cursor(
+            c, dtypes=table_dtypes(self.conn, 'obs'))
         if add_prefix is not None:
             results.keys = [add_prefix + k for k in results.keys]
         return results
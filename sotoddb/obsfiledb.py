@@ -1,8 +1,11 @@
 import sqlite3
 import os
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 
+from . import dbio
+
 TABLE_DEFS = {
     'detsets': [
         "`name`    varchar(16)",
@@ -30,6 +33,24 @@ TABLE_DEFS = {
 }
 
 
+def _encode(values):
+    """Returns (distinct, codes), where distinct is a list of the
+    distinct entries of values and codes is an integer array such that
+    distinct[codes[i]] == values[i].  The distinct values are sorted,
+    if possible.
+
+    """
+    try:
+        distinct, codes = np.unique(np.array(values), return_inverse=True)
+        return distinct.tolist(), codes.reshape(-1).astype(int)
+    except TypeError:
+        # Values can't be ordered (e.g. None with ints).
+        lookup = {}
+        codes = np.array([lookup.setdefault(v, len(lookup)) for v in values],
+                         dtype=int)
+        return list(lookup.keys()), codes
+
+
 class ObsFileDB:
     """sqlite3-based database for managing large archives of files.
 
@@ -55,6 +76,10 @@ class ObsFileDB:
     #: from this database.
     prefix = ''
 
+    #: The maximum number of get_files results to cache.  Set this to
+    #: a positive number to enable the cache.
+    cache_size = 0
+
     def __init__(self, map_file=None, prefix=None, init_db=True, readonly=False):
         """Instantiate an ObsFileDB.
 
@@ -82,6 +107,8 @@ class ObsFileDB:
 
         self.conn = sqlite3.connect(map_file, uri=uri)
         self.conn.row_factory = sqlite3.Row  # access columns by name
+        self._cache = OrderedDict()
+        self._cache_stats = {'hits': 0, 'misses': 0}
 
         if init_db and not readonly:
             self._create()
@@ -122,23 +149,27 @@ class ObsFileDB:
         print('Use of ObsFileDb.for_dir() is deprecated... use from_file.')
         return cls.from_file(os.path.join(path, filename), prefix=path)
 
-    def copy(self, map_file=None, overwrite=False):
+    def copy(self, map_file=None, overwrite=False, pages=-1, progress=None):
         """
         Duplicate the current database into a new database object, and
         return it.  If map_file is specified, the new database will be
         connected to that sqlite file on disk.  Note that a quick way
         of writing a DB to disk to call copy(map_file=...).
+
+        The pages and progress arguments are passed to
+        dbio.copy_db, and may be used to copy the data in steps and
+        monitor progress.
         """
         if map_file is None:
             map_file = ':memory:'
-        script = ' '.join(self.conn.iterdump())
         if map_file != ':memory:' and os.path.exists(map_file):
             if not overwrite:
                 raise RuntimeError("Output database '%s' exists -- remove or "
                                    "pass overwrite=True to copy." % map_file)
             os.remove(map_file)
         new_db = ObsFileDB(map_file, init_db=False)
-        new_db.conn.executescript(script)
+        dbio.copy_db(self.conn, new_db.conn, pages=pages,
+                     progress=progress)
         new_db.prefix = self.prefix
         return new_db
 
@@ -192,6 +223,7 @@ class ObsFileDB:
             'insert into files (name,detset,obs_id,sample_start,sample_stop) '
             'values (?,?,?,?,?)',
             (filename,detset,obs_id,sample_start,sample_stop))
+        self.clear_cache()
         if commit:
             self.conn.commit()
 
@@ -233,22 +265,159 @@ class ObsFileDB:
         if prefix is None:
             prefix = self.prefix
 
-        if detsets is None:
-            detsets = self.get_detsets(obs_id)
+        cache_key = None
+        if self.cache_size > 0:
+            cache_key = (obs_id, None if detsets is None else tuple(detsets),
+                         prefix)
+            if cache_key in self._cache:
+                self._cache_stats['hits'] += 1
+                self._cache.move_to_end(cache_key)
+                return OrderedDict([(k, list(v)) for k, v in
+                                    self._cache[cache_key].items()])
+            self._cache_stats['misses'] += 1
+
+        detset_clause = ''
+        args = (obs_id,)
+        if detsets is not None:
+            detset_clause = ' and detset in (%s)' % ','.join(
+                ['?' for _ in detsets])
+            args = args + tuple(detsets)
 
         c = self.conn.execute('select detset, name, sample_start, sample_stop '
-                              'from files where obs_id=? and detset in (%s) '
-                              'order by detset, sample_start' %
-                              ','.join(['?' for _ in detsets]),
-                              (obs_id,) + tuple(detsets))
+                              'from files where obs_id=?%s '
+                              'order by detset, sample_start' % detset_clause,
+                              args)
         output = OrderedDict()
         for r in c:
             if not r[0] in output:
                 output[r[0]] = []
             output[r[0]].append((prefix + r[1], r[2], r[3]))
+
+        if cache_key is not None:
+            self._cache[cache_key] = OrderedDict(
+                [(k, list(v)) for k, v in output.items()])
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return output
+
+    def get_files_multi(self, obs_ids, detsets=None, prefix=None):
+        """Get the file names associated with each of a list of obs_id,
+        using a single query.
+
+        Arguments:
+          obs_ids (list of str): The observations to look up.
+          detsets (list of str): The detsets to include.  If None,
+            all detsets are included.
+          prefix (str): As for get_files.
+
+        Returns:
+
+          OrderedDict where the key is the obs_id and the value is
+          the OrderedDict that get_files would return for that
+          obs_id.
+
+        """
+        if prefix is None:
+            prefix = self.prefix
+        obs_ids = list(OrderedDict.fromkeys(obs_ids))
+
+        # Don't commit any transaction the caller has open.
+        in_transaction = self.conn.in_transaction
+        c = self.conn.cursor()
+        c.execute('drop table if exists _obs_ids')
+        c.execute('create temp table _obs_ids (`obs_id` varchar(256))')
+        c.executemany('insert into _obs_ids (obs_id) values (?)',
+                      [(x,) for x in obs_ids])
+        detset_clause = ''
+        args = ()
+        if detsets is not None:
+            detset_clause = 'where files.detset in (%s) ' % ','.join(
+                ['?' for _ in detsets])
+            args = tuple(detsets)
+        c.execute('select files.obs_id, detset, name, sample_start, '
+                  'sample_stop from _obs_ids join files on '
+                  '_obs_ids.obs_id=files.obs_id %s'
+                  'order by _obs_ids.rowid, detset, sample_start' %
+                  detset_clause, args)
+        output = OrderedDict([(x, OrderedDict()) for x in obs_ids])
+        for r in c:
+            files = output[r[0]]
+            if not r[1] in files:
+                files[r[1]] = []
+            files[r[1]].append((prefix + r[2], r[3], r[4]))
+        c.execute('drop table _obs_ids')
+        if not in_transaction:
+            c.execute('end transaction')
         return output
 
-    def verify(self):
+    def clear_cache(self):
+        """Empty the get_files cache (see cache_size).  This is called
+        automatically when files are added to or dropped from the
+        database.
+
+        """
+        self._cache.clear()
+
+    def cache_info(self):
+        """Returns a dict with the number of 'hits' and 'misses' of the
+        get_files cache, and its current 'size'.
+
+        """
+        return dict(self._cache_stats, size=len(self._cache))
+
+    @staticmethod
+    def _check_paths(paths, workers=None, by_dir=False, progress=None,
+                     chunk_size=1000):
+        """Check the filesystem for each of the paths, returning a list of
+        bools indicating which ones exist.  See verify() for a
+        description of the arguments.
+
+        """
+        if by_dir:
+            # One task per directory.
+            groups = OrderedDict()
+            for i, p in enumerate(paths):
+                d, f = os.path.split(p)
+                groups.setdefault(d, []).append((i, f))
+            tasks = list(groups.items())
+
+            def check(task):
+                d, items = task
+                try:
+                    names = set([e.name for e in os.scandir(d or '.')])
+                except (FileNotFoundError, NotADirectoryError):
+                    names = set()
+                return [(i, f in names) for i, f in items]
+        else:
+            items = list(enumerate(paths))
+            tasks = [items[i:i + chunk_size]
+                     for i in range(0, len(items), chunk_size)]
+
+            def check(task):
+                return [(i, os.path.exists(p)) for i, p in task]
+
+        present = [False] * len(paths)
+        n_done = 0
+
+        def record(result):
+            nonlocal n_done
+            for i, ok in result:
+                present[i] = ok
+            n_done += len(result)
+            if progress is not None:
+                progress(n_done, len(paths))
+
+        if workers is None or workers <= 1:
+            for task in tasks:
+                record(check(task))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(check, task) for task in tasks]
+                for future in as_completed(futures):
+                    record(future.result())
+        return present
+
+    def verify(self, workers=None, by_dir=False, progress=None):
         """Check the filesystem for the presence of files described in the
         database.  Returns a dictionary containing this information in
         various forms; see code for details.
@@ -257,14 +426,24 @@ class ObsFileDB:
         function, and may also be useful for debugging file-finding
         problems.
 
+        Arguments:
+          workers (int): If greater than 1, the filesystem is checked
+            using a pool of this many threads.
+          by_dir (bool): If True, then rather than checking each file
+            individually, each directory is listed (once) and the
+            file names are looked up in the listing.
+          progress (callable): If not None, this is called as the
+            check proceeds, with arguments (n_checked, n_total).
+
         """
         # Check for the presence of each listed file.
         c = self.conn.execute('select name, obs_id, detset, sample_start '
                               'from files')
-        rows = []
-        for r in c:
-            fp = self.prefix + r[0]
-            rows.append((os.path.exists(fp), fp) + tuple(r))
+        db_rows = [tuple(r) for r in c]
+        paths = [self.prefix + r[0] for r in db_rows]
+        present = self._check_paths(paths, workers=workers, by_dir=by_dir,
+                                    progress=progress)
+        rows = [(ok, fp) + r for ok, fp, r in zip(present, paths, db_rows)]
 
         obs = OrderedDict()
         for r in rows:
@@ -278,22 +457,58 @@ class ObsFileDB:
                 obs[obs_id]['absent'].append((detset, sample_start))
 
         # Make a detset, sample_start grid for each observation.
-        grids = OrderedDict()
-        for k, v in obs.items():
-            items = v['present']
-            detsets = list(set([a for a, b in items]))
-            sample_starts = list(set([b for a, b in items]))
-            grid = np.zeros((len(detsets), len(sample_starts)), bool)
-            for a, b in items:
-                grid[detsets.index(a), sample_starts.index(b)] = True
-            grids[k] = {'detset': detsets,
-                        'sample_start': sample_starts,
-                        'grid': grid}
+        grids = self._get_grids([r for r in rows if r[0]], list(obs.keys()))
 
         return {'raw': rows,
                 'obs_id': obs,
                 'grids': grids}
 
+    @staticmethod
+    def _get_grids(rows, obs_ids):
+        """Build the detset, sample_start coverage grid for each
+        observation in obs_ids, from the rows (in the format of
+        verify()['raw']) of the files that are present.
+
+        """
+        # Code each row by the index of its obs_id in obs_ids.
+        codes = _encode(obs_ids + [r[3] for r in rows])[1]
+        obs_index = np.empty(len(obs_ids), int)
+        obs_index[codes[:len(obs_ids)]] = np.arange(len(obs_ids))
+        obs_code = obs_index[codes[len(obs_ids):]]
+        detsets, ds_code = _encode([r[4] for r in rows])
+        starts, ss_code = _encode([r[5] for r in rows])
+        # Index of each (obs, detset) and (obs, sample_start) pair,
+        # sorted by obs.
+        ds_pairs, ds_idx = np.unique(obs_code * len(detsets) + ds_code,
+                                     return_inverse=True)
+        ss_pairs, ss_idx = np.unique(obs_code * len(starts) + ss_code,
+                                     return_inverse=True)
+        # Slices of the pair lists and rows, for each obs.
+        n_obs = len(obs_ids)
+        ds_edges = np.searchsorted(ds_pairs // max(len(detsets), 1),
+                                   np.arange(n_obs + 1))
+        ss_edges = np.searchsorted(ss_pairs // max(len(starts), 1),
+                                   np.arange(n_obs + 1))
+        order = np.argsort(obs_code, kind='stable')
+        row_edges = np.searchsorted(obs_code[order], np.arange(n_obs + 1))
+
+        grids = OrderedDict()
+        for i, obs_id in enumerate(obs_ids):
+            ds_sl = slice(ds_edges[i], ds_edges[i+1])
+            ss_sl = slice(ss_edges[i], ss_edges[i+1])
+            rows_i = order[row_edges[i]:row_edges[i+1]]
+            grid = np.zeros((ds_sl.stop - ds_sl.start,
+                             ss_sl.stop - ss_sl.start), bool)
+            grid[ds_idx[rows_i] - ds_sl.start,
+                 ss_idx[rows_i] - ss_sl.start] = True
+            grids[obs_id] = {
+                'detset': [detsets[j] for j in
+                           ds_pairs[ds_sl] % len(detsets)],
+                'sample_start': [starts[j] for j in
+                                 ss_pairs[ss_sl] % len(starts)],
+                'grid': grid}
+        return grids
+
     def drop_obs(self, obs_id):
         """Delete the specified obs_id from the database.  Returns a list of
         files that are no longer covered by the databse (with prefix).
@@ -310,6 +525,7 @@ class ObsFileDB:
         self.conn.execute('delete from files where obs_id=?',
                           (obs_id,))
         self.conn.commit()
+        self.clear_cache()
         return affected_files
 
     def drop_detset(self, detset):
@@ -329,9 +545,10 @@ class ObsFileDB:
         self.conn.execute('delete from files where detset=?',
                           (detset,))
         self.conn.commit()
+        self.clear_cache()
         return affected_files
 
-    def drop_incomplete(self):
+    def drop_incomplete(self, workers=None, by_dir=False, progress=None):
         """Compare the files actually present on the system to the ones listed
         in this database.  Drop detsets from each observation, as
         necessary, such that the database is consistent with the file
@@ -340,31 +557,29 @@ class ObsFileDB:
         Returns a list of files that are on the system but are no
         longer included in the database.
 
+        The arguments are passed to verify().
+
         """
-        affected_files = []
-        scan = self.verify()
+        scan = self.verify(workers=workers, by_dir=by_dir, progress=progress)
+        to_drop = set()
         for obs_id, info in scan['grids'].items():
             # Drop any detset that does not have complete sample
             # coverage.
             detset_to_drop = np.any(~info['grid'], axis=1)
             for i in detset_to_drop.nonzero()[0]:
-                affected_files.extend(
-                    [r[0] for r in self.conn.execute(
-                        'select name from files where obs_id=? and detset=?',
-                        (obs_id, info['detset'][i]))])
-                self.conn.execute(
-                    'delete from files where obs_id=? and detset=?',
-                    (obs_id, info['detset'][i]))
+                to_drop.add((obs_id, info['detset'][i]))
+        self.conn.executemany('delete from files where obs_id=? and detset=?',
+                              sorted(to_drop))
         # Drop any detset that no longer appear in any files.
         self.conn.execute('delete from detsets where name not in '
                             '(select distinct detset from files)')
         self.conn.commit()
         self.conn.execute('vacuum')
+        self.clear_cache()
 
         # Return the full paths of only the existing files that have
         # been dropped from the DB.
-        path_map = {r[2]: r[1] for r in scan['raw'] if r[0]}
-        return [r[1] for r in scan['raw'] if r[2] in affected_files]
+        return [r[1] for r in scan['raw'] if (r[3], r[4]) in to_drop]
 
     def get_file_list(self, fout=None):
         """Returns a list of all files in the database, without the file
@@ -42,8 +42,12 @@ The ManifestScheme includes:
 
 import sqlite3
 import os
+import re
 import numpy as np
 
+from . import dbio
+from .resultset import ResultSet, table_dtypes
+
 TABLE_DEFS = {
     'input_scheme': [
         "`id`      integer primary key autoincrement",
@@ -63,9 +67,43 @@ TABLE_DEFS = {
 }
 
 
+class MatchQuery:
+    """A compiled query for matching Index Data against the map table of
+    a ManifestDB.  This holds the SQL text, the names of the
+    parameters in the order they must be bound, and the names of the
+    output columns.  Obtain these from ManifestScheme.get_matcher.
+
+    """
+    def __init__(self, scheme, param_names):
+        q, arg_names, ret_cols = scheme._get_match_clauses(param_names)
+        cols = ['files`.`name'] + list(ret_cols)
+        where_str = ''
+        if len(q):
+            where_str = ' where %s' % q
+        #: The SQL query text.  The rows are returned in the order
+        #: they were added to the map, regardless of the indexes.
+        self.query = ('select `%s` ' % ('`,`'.join(cols)) +
+                      'from map join files on map.file_id=files.id' +
+                      where_str + ' order by map.id')
+        #: The names of the Index Data values, in binding order.
+        self.arg_names = arg_names
+        #: The keys of the Endpoint Data returned for each row.
+        self.keys = ['filename'] + list(ret_cols)
+
+    def bind(self, params):
+        """Returns the tuple of values to bind to the query, taken from
+        params (a dict of Index Data).
+
+        """
+        return tuple([params[k] for k in self.arg_names])
+
+
 class ManifestScheme:
     def __init__(self):
         self.cols = []
+        self._matchers = {}
+        #: Counts of cache 'hits' and 'misses' in get_matcher.
+        self.matcher_stats = {'hits': 0, 'misses': 0}
 
     # Methods for constructing table.
 
@@ -74,6 +112,7 @@ class ManifestScheme:
         Add a field to the scheme, that must be matched exactly.
         """
         self.cols.append((name, 'in', 'exact', dtype))
+        self._matchers.clear()
         return self
 
     def add_range_match(self, name, purpose='in', dtype='varchar(16)'):
@@ -82,6 +121,7 @@ class ManifestScheme:
         matched by a single input value.
         """
         self.cols.append((name, purpose, 'range', dtype))
+        self._matchers.clear()
         return self
 
     def add_data_field(self, name, dtype='varchar(16)'):
@@ -90,6 +130,7 @@ class ManifestScheme:
         filename.
         """
         self.cols.append((name, 'out', 'exact', dtype))
+        self._matchers.clear()
         return self
 
     def _get_scheme_rows(self):
@@ -124,6 +165,30 @@ class ManifestScheme:
                 raise ValueError("Bad ctype '%s'" % match)
         return entries
 
+    def _get_map_index_defs(self):
+        """
+        Returns a list of (index_name, columns) for the indexes that
+        should be created on the map table, to speed up matching.
+        The exact-match input columns come first in each index; the
+        first index ends with the __lo and __hi columns of the first
+        range-match input, and each additional range-match input
+        gets an index ending with its own __lo column.
+        """
+        exact = [c[0] for c in self.cols
+                 if c[1] == 'in' and c[2] == 'exact']
+        ranges = [c[0] for c in self.cols
+                  if c[1] == 'in' and c[2] == 'range']
+        if len(ranges) == 0:
+            if len(exact) == 0:
+                return []
+            return [('idx_map_exact', exact)]
+        index_defs = [('idx_map_range_%s' % ranges[0],
+                       exact + [ranges[0] + '__lo', ranges[0] + '__hi'])]
+        for name in ranges[1:]:
+            index_defs.append(('idx_map_range_%s' % name,
+                               exact + [name + '__lo']))
+        return index_defs
+
     @classmethod
     def from_database(cls, conn, table_name='input_scheme'):
         """
@@ -141,34 +206,63 @@ class ManifestScheme:
                 raise ValueError("Bad ctype '%s'" % match)
         return self
 
-    def get_match_query(self, params):
+    def _get_match_clauses(self, param_names):
         """
         Arguments:
-          params: a dict of values to match against.
+          param_names: the names of the values that will be matched
+            against.
 
         Returns:
-          (where_string, values_tuple, ret_cols)
+          (where_string, arg_names, ret_cols), where arg_names lists
+          the parameter to bind to each ? in where_string.
         """
         qs = []
-        vals = []
+        arg_names = []
         ret_cols = []
         for col in self.cols:
             (name, purpose, match, dtype) = col
             if purpose == 'in':
-                if not name in params:
+                if not name in param_names:
                     raise ValueError('Parameter %s is not optional.' % name)
                 if match == 'exact':
                     qs.append('`%s`=?' % name)
-                    vals.append(params[name])
+                    arg_names.append(name)
                 elif match == 'range':
                     qs.append('(`%s__lo` <= ?) and (? < `%s__hi`)' % (name, name))
-                    vals.extend([params[name], params[name]])
+                    arg_names.extend([name, name])
                 else:
                     raise ValueError("Bad ctype '%s'" % match)
             if purpose == 'out':
                 # Include that column's value in result.
                 ret_cols.append(name)
-        return (' and '.join(qs), tuple(vals), ret_cols)
+        return (' and '.join(qs), arg_names, ret_cols)
+
+    def get_match_query(self, params):
+        """
+        Arguments:
+          params: a dict of values to match against.
+
+        Returns:
+          (where_string, values_tuple, ret_cols)
+        """
+        q, arg_names, ret_cols = self._get_match_clauses(params)
+        return (q, tuple([params[k] for k in arg_names]), ret_cols)
+
+    def get_matcher(self, params):
+        """Returns a MatchQuery for the Index Data params (a dict).  The
+        MatchQuery depends only on the set of keys in params, and is
+        cached so that it is only constructed once for each such set.
+
+        """
+        key = frozenset(params.keys())
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            self.matcher_stats['misses'] += 1
+            matcher = MatchQuery(self, key)
+            self._matchers[key] = matcher
+        else:
+            self.matcher_stats['hits'] += 1
+        return matcher
 
     def get_insertion_query(self, params):
         qs = []
@@ -198,6 +292,243 @@ class ManifestScheme:
         return [c[0] for c in self.cols if c[1] == 'in']
 
 
+#: Text that sqlite will convert to a number, when it is compared to a
+#: column with INTEGER or REAL affinity.
+_NUMERIC_TEXT = re.compile(
+    r'^\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?\s*$')
+
+
+def _sqlite_text(v):
+    """Returns the text that sqlite converts number v to (as in
+    cast(v as text)), or None for NaN.
+
+    """
+    if isinstance(v, (float, np.floating)):
+        v = float(v)
+        if v != v:
+            return None
+        if v in (float('inf'), float('-inf')):
+            return 'Inf' if v > 0 else '-Inf'
+        if v == 0:
+            return '0.0'
+        # sqlite uses printf('%!.15g'), which always includes a '.'.
+        text = '%.15g' % v
+        mant, e, exp = text.partition('e')
+        if '.' not in mant:
+            mant += '.0'
+        return mant + e + exp
+    return str(int(v))
+
+
+def _affinity_values(values, dtype, keep_text=False):
+    """Convert a list of query values to the type that sqlite would
+    compare them as, against a column whose values were loaded with
+    dtype (see table_dtypes).  Returns (values, valid), where valid is
+    False for values that can not be equal to any value in the column.
+    For numeric columns, text that is not a number is marked invalid,
+    unless keep_text (for columns that also hold text).
+
+    """
+    arr = np.asarray(values)
+    if dtype is None or (dtype.kind == 'U' and arr.dtype.kind == 'U') or \
+       (dtype.kind != 'U' and arr.dtype.kind in 'biuf'):
+        return arr, np.ones(len(arr), bool)
+    values = list(values)
+    valid = np.array([v is not None for v in values], bool)
+    if dtype.kind == 'U':
+        out = []
+        for i, v in enumerate(values):
+            if v is not None and not isinstance(v, str):
+                v = _sqlite_text(v)
+            if v is None:
+                valid[i] = False
+                v = ''
+            out.append(v)
+        return np.array(out, str), valid
+    out = []
+    for i, v in enumerate(values):
+        if isinstance(v, str):
+            if _NUMERIC_TEXT.match(v):
+                try:
+                    v = int(v)
+                except ValueError:
+                    v = float(v)
+            elif not keep_text:
+                valid[i] = False
+                v = 0
+        elif v is None:
+            v = 0
+        out.append(v)
+    if any([isinstance(v, str) for v in out]):
+        return np.array(out, dtype=object), valid
+    return np.array(out), valid
+
+
+class FrozenManifest:
+    """In-memory copy of the map and files tables of a ManifestDB,
+    organized so that Index Data can be matched with vectorized
+    binary searches.  This is normally used through
+    ManifestDB.freeze().
+
+    The rows are grouped by the values of the exact-match inputs, and
+    sorted within each group by the lower bound of the first
+    range-match input (if any).  For each query, the group is found by
+    searchsorted on the exact values; the rows whose lower bound is
+    not above the query value form a prefix of the group, and the
+    rows whose upper bound may be above the query value form a suffix
+    (found using the running maximum of the upper bounds).  Only the
+    rows in the intersection are then checked against all range
+    conditions.
+
+    """
+    def __init__(self, manifest_db):
+        scheme = manifest_db.scheme
+        self.exact = [c[0] for c in scheme.cols
+                      if c[1] == 'in' and c[2] == 'exact']
+        self.ranges = [c[0] for c in scheme.cols
+                       if c[1] == 'in' and c[2] == 'range']
+        self.ret_cols = [c[0] for c in scheme.cols if c[1] == 'out']
+        range_cols = []
+        for name in self.ranges:
+            range_cols.extend([name + '__lo', name + '__hi'])
+        cols = self.exact + range_cols + self.ret_cols
+        c = manifest_db.conn.execute(
+            'select map.id, files.name%s from map join files on '
+            'map.file_id=files.id' % ''.join([',map.`%s`' % k
+                                              for k in cols]))
+        map_dtypes = table_dtypes(manifest_db.conn, 'map')
+        self._dtypes = {k: map_dtypes.get(k) for k in self.exact}
+        self._dtypes.update({k: map_dtypes.get(k + '__lo')
+                             for k in self.ranges})
+        rs = ResultSet.from_cursor(
+            c, keys=['id', 'filename'] + cols,
+            dtypes=[map_dtypes['id'], np.dtype(str)] +
+            [map_dtypes.get(k) for k in cols])
+        n = len(rs)
+
+        # Reduce the exact-match columns to a single group code,
+        # one column at a time.
+        group = np.zeros(n, int)
+        self._steps = []
+        for name in self.exact:
+            try:
+                distinct, codes = np.unique(rs[name], return_inverse=True)
+            except TypeError:
+                # Values can't be ordered (e.g. NULL, or ints mixed
+                # with text); label them through a dict instead.
+                distinct = {}
+                codes = np.array([distinct.setdefault(v, len(distinct))
+                                  for v in rs[name].tolist()], dtype=int)
+            key = group * len(distinct) + codes.reshape(-1)
+            uniq, group = np.unique(key, return_inverse=True)
+            group = group.reshape(-1)
+            self._steps.append((name, distinct, uniq))
+        self._distinct = {step[0]: step[1] for step in self._steps}
+        n_groups = int(group.max()) + 1 if n else 0
+
+        for k in range_cols:
+            if rs[k].dtype.kind == 'O':
+                try:
+                    np.unique(rs[k])
+                except TypeError:
+                    raise ValueError('Range column %s has values that '
+                                     'can not be ordered (e.g. NULL); '
+                                     'it can not be frozen.' % k)
+
+        if len(self.ranges):
+            lo = rs[self.ranges[0] + '__lo']
+            order = np.lexsort([rs['id'], lo, group])
+        else:
+            order = np.lexsort([rs['id'], group])
+        self.group = group[order]
+        self.data = {k: rs[k][order] for k in rs.keys}
+        self.group_edges = np.searchsorted(self.group, np.arange(n_groups + 1))
+
+        if len(self.ranges):
+            lo = self.data[self.ranges[0] + '__lo']
+            hi = self.data[self.ranges[0] + '__hi']
+            # Combine group and the ranks of lo and of the running max
+            # of hi, into keys that increase monotonically.
+            self.lo_u = np.unique(lo)
+            self.lo_key = (self.group * (len(self.lo_u) + 1) +
+                           np.searchsorted(self.lo_u, lo))
+            self.hi_u = np.unique(hi)
+            self.hi_key = np.maximum.accumulate(
+                self.group * (len(self.hi_u) + 1) +
+                np.searchsorted(self.hi_u, hi)) if n else np.zeros(0, int)
+
+    def match_columns(self, columns, n):
+        """Match n items of Index Data, passed as a dict mapping each
+        input key to a list of n values.  Returns a ResultSet with the
+        same layout as the flat output of ManifestDB.match_many.
+        Values are converted according to the affinity of the map
+        columns, as they would be by sqlite.
+
+        """
+        ok = np.ones(n, bool) & (len(self.group) > 0)
+        columns = dict(columns)
+        for name in self.exact + self.ranges:
+            columns[name], valid = _affinity_values(
+                columns[name], self._dtypes[name],
+                keep_text=isinstance(self._distinct.get(name), dict))
+            ok &= valid
+
+        # Find the group of each query.
+        qgroup = np.zeros(n, int)
+        for name, distinct, uniq in self._steps:
+            if not np.any(ok):
+                break
+            vals = columns[name]
+            if isinstance(distinct, dict):
+                # NULL never matches, as in sqlite.
+                code = np.array([-1 if v is None else distinct.get(v, -1)
+                                 for v in vals.tolist()], dtype=int)
+                ok &= (code >= 0)
+                code[code < 0] = 0
+            else:
+                code = np.searchsorted(distinct, vals)
+                code[code >= len(distinct)] = 0
+                ok &= (distinct[code] == vals)
+            key = qgroup * len(distinct) + code
+            qgroup = np.searchsorted(uniq, key)
+            qgroup[qgroup >= len(uniq)] = 0
+            ok &= (uniq[qgroup] == key)
+        qgroup[~ok] = 0
+        start = np.zeros(n, int)
+        end = np.zeros(n, int)
+        if len(self.group):
+            start = self.group_edges[qgroup]
+            end = self.group_edges[qgroup + 1]
+
+        if len(self.ranges) and len(self.group):
+            v = columns[self.ranges[0]]
+            end = np.searchsorted(
+                self.lo_key, qgroup * (len(self.lo_u) + 1) +
+                np.searchsorted(self.lo_u, v, side='right'))
+            start = np.maximum(start, np.searchsorted(
+                self.hi_key, qgroup * (len(self.hi_u) + 1) +
+                np.searchsorted(self.hi_u, v, side='right')))
+        counts = np.where(ok, np.maximum(end - start, 0), 0)
+
+        # Expand to (query, row) candidate pairs, and check ranges.
+        qi = np.repeat(np.arange(n), counts)
+        rows = (np.repeat(start - np.cumsum(counts) + counts, counts) +
+                np.arange(len(qi)))
+        mask = np.ones(len(qi), bool)
+        for name in self.ranges:
+            v = columns[name][qi]
+            mask &= ((self.data[name + '__lo'][rows] <= v) &
+                     (v < self.data[name + '__hi'][rows]))
+        qi, rows = qi[mask], rows[mask]
+        order = np.lexsort([self.data['id'][rows], qi])
+        qi, rows = qi[order], rows[order]
+
+        keys = ['filename'] + self.ret_cols
+        return ResultSet.from_columns(
+            [qi] + [self.data[k][rows] for k in keys],
+            keys=['input_index'] + keys)
+
+
 class ManifestDB:
     """
     Expose a map from Index Data to Endpoint Data, including a
@@ -216,11 +547,16 @@ class ManifestDB:
         database will be connected to the indicated sqlite file on
         disk, and any changes made to this object be written back to
         the file.
+
+        The queries used by match() are compiled once for each set of
+        Index Data keys, and cached in the scheme; see
+        ManifestScheme.get_matcher and the scheme's matcher_stats.
         """
         if map_file is None:
             map_file = ':memory:'
         self.conn = sqlite3.connect(map_file)
         self.conn.row_factory = sqlite3.Row  # access columns by name
+        self._frozen = None
 
         if scheme is not None:
             self._create(scheme)
@@ -250,14 +586,37 @@ class ManifestDB:
         self.conn.commit()
 
         self.scheme = ManifestScheme.from_database(self.conn)
+        self.ensure_indexes()
+
+    def ensure_indexes(self, commit=True):
+        """Create any missing indexes on the map and files tables.  This
+        is done automatically when a new database is created, but
+        may be called to add the indexes to files created by older
+        versions of the code.  See ManifestScheme._get_map_index_defs
+        for the indexes that are made.
+
+        """
+        index_defs = [('idx_files_name', 'files', ['name'])]
+        index_defs += [(name, 'map', cols) for name, cols in
+                       self.scheme._get_map_index_defs()]
+        for name, table, cols in index_defs:
+            self.conn.execute(
+                'create index if not exists `%s` on `%s` (%s)' %
+                (name, table, ','.join(['`%s`' % col for col in cols])))
+        if commit:
+            self.conn.commit()
 
-    def copy(self, map_file=None, overwrite=False):
+    def copy(self, map_file=None, overwrite=False, pages=-1, progress=None):
         """
         Duplicate the current database into a new database object, and
         return it.  If map_file is specified, the new database will be
         connected to that sqlite file on disk.  Note that a quick way
         of writing a DB to disk to call copy(map_file=...) and then
         simply discard the returned object.
+
+        The pages and progress arguments are passed to
+        dbio.copy_db, and may be used to copy the data in steps and
+        monitor progress.
         """
         if map_file is not None and os.path.exists(map_file):
             if overwrite:
@@ -266,8 +625,8 @@ class ManifestDB:
                 raise RuntimeError("Output file %s exists (overwrite=True "
                                    "to overwrite)." % map_file)
         new_db = ManifestDB(map_file=map_file, init_db=False)
-        script = ' '.join(self.conn.iterdump())
-        new_db.conn.executescript(script)
+        dbio.copy_db(self.conn, new_db.conn, pages=pages,
+                     progress=progress)
         new_db.scheme = ManifestScheme.from_database(new_db.conn)
         return new_db
 
@@ -300,16 +659,16 @@ class ManifestDB:
           or more items.
 
         """
-        q, p, rp = self.scheme.get_match_query(params)
-        cols = ['files`.`name'] + list(rp)
-        c = self.conn.cursor()
-        where_str = ''
-        if len(q):
-            where_str = 'where %s' % q
-        c.execute('select `%s` ' % ('`,`'.join(cols)) + 
-                  'from map join files on map.file_id=files.id %s' % where_str, p)
-        rows = c.fetchall()
-        rp.insert(0, 'filename')
+        matcher = self.scheme.get_matcher(params)
+        if self._frozen is not None:
+            rows = self._frozen.match_columns(
+                {k: [params[k]] for k in set(matcher.arg_names)}, 1).rows
+            rows = [r[1:] for r in rows]
+        else:
+            c = self.conn.cursor()
+            c.execute(matcher.query, matcher.bind(params))
+            rows = c.fetchall()
+        rp = matcher.keys
         if multi:
             return [dict(zip(rp, r)) for r in rows]
         if len(rows) == 0:
@@ -318,6 +677,120 @@ class ManifestDB:
             raise WTF()
         return dict(zip(rp, rows[0]))
 
+    def match_many(self, params_list, flat=False):
+        """Given a list of Index Data, return the Endpoint Data for each.
+        All the matching is done in a single query, by loading the
+        Index Data into a temporary table and joining it against the
+        map.
+
+        Arguments:
+
+          params_list: a list of dicts of Index Data; or a
+            structured numpy array or ResultSet with a field for each
+            Index Data key.
+
+          flat: if True, return the results as a single ResultSet.
+
+        Returns:
+
+          If flat=False, a list with one entry per item of
+          params_list; each entry is the list of Endpoint Data dicts
+          that match(params, multi=True) would return.  If flat=True,
+          a ResultSet with a column 'input_index' giving the index of
+          the matched item in params_list, followed by the Endpoint
+          Data columns.
+
+        """
+        in_cols = [col for col in self.scheme.cols if col[1] == 'in']
+        names = [col[0] for col in in_cols]
+        if isinstance(params_list, np.ndarray):
+            params_list = ResultSet.from_friend(params_list)
+        if isinstance(params_list, ResultSet):
+            for name in names:
+                if name not in params_list.keys:
+                    raise ValueError('Parameter %s is not optional.' % name)
+            columns = [params_list[name].tolist() for name in names]
+        else:
+            columns = []
+            for name in names:
+                try:
+                    columns.append([p[name] for p in params_list])
+                except KeyError:
+                    raise ValueError('Parameter %s is not optional.' % name)
+        n = len(params_list)
+        ret_cols = [col[0] for col in self.scheme.cols if col[1] == 'out']
+        keys = ['filename'] + ret_cols
+
+        if self._frozen is not None:
+            results = self._frozen.match_columns(dict(zip(names, columns)), n)
+        else:
+            results = self._match_many_sql(in_cols, columns, ret_cols, n)
+        if flat:
+            return results
+        output = [[] for i in range(n)]
+        for row in results.rows:
+            output[row[0]].append(dict(zip(keys, row[1:])))
+        return output
+
+    def _match_many_sql(self, in_cols, columns, ret_cols, n):
+        """Run the match_many query in sqlite.  columns is a list of
+        lists of n values, one for each of in_cols.
+
+        """
+        names = [col[0] for col in in_cols]
+        # Don't commit any transaction the caller has open.
+        in_transaction = self.conn.in_transaction
+        c = self.conn.cursor()
+        c.execute('drop table if exists _match_inputs')
+        # Declare the inputs with the map column types, so values are
+        # converted by the same affinity rules as in match().
+        c.execute('create temp table _match_inputs (`_idx` integer%s)' %
+                  ''.join([',`%s` %s' % (col[0], col[3]) for col in in_cols]))
+        c.executemany('insert into _match_inputs values (%s)' %
+                      ','.join(['?'] * (len(names) + 1)),
+                      zip(range(n), *columns))
+
+        joins = []
+        for (name, purpose, match, dtype) in in_cols:
+            if match == 'exact':
+                joins.append('map.`%s`=_match_inputs.`%s`' % (name, name))
+            elif match == 'range':
+                joins.append('(map.`%s__lo` <= _match_inputs.`%s`) and '
+                             '(_match_inputs.`%s` < map.`%s__hi`)' %
+                             (name, name, name, name))
+        if len(joins) == 0:
+            joins.append('1')
+        c.execute('select _match_inputs._idx, files.name%s '
+                  'from _match_inputs join map on %s '
+                  'join files on map.file_id=files.id '
+                  'order by _match_inputs._idx, map.id' %
+                  (''.join([',map.`%s`' % k for k in ret_cols]),
+                   ' and '.join(joins)))
+        map_dtypes = table_dtypes(self.conn, 'map')
+        results = ResultSet.from_cursor(
+            c, keys=['input_index', 'filename'] + ret_cols,
+            dtypes=[np.dtype(int), np.dtype(str)] +
+            [map_dtypes.get(k) for k in ret_cols])
+        c.execute('drop table _match_inputs')
+        if not in_transaction:
+            c.execute('end transaction')
+        return results
+
+    def freeze(self):
+        """Load the map and files tables into memory (as a FrozenManifest),
+        so that subsequent calls to match and match_many are answered
+        without querying sqlite.  The results are the same as those
+        from the database.  While frozen, entries cannot be added.
+        Returns self.
+
+        """
+        self._frozen = FrozenManifest(self)
+        return self
+
+    def thaw(self):
+        """Undo freeze(); subsequent matches will query the database."""
+        self._frozen = None
+
     def add_entry(self, params, filename=None, create=True, commit=True):
         """
         Add an entry to the map table.
@@ -337,6 +810,9 @@ class ManifestDB:
           commit: if False, do not commit changes to the database (for
             batch use).
         """
+        if self._frozen is not None:
+            raise RuntimeError('Cannot add entries to a frozen ManifestDB; '
+                               'call thaw() first.')
         # Validate the input data.
         q, p = self.scheme.get_insertion_query(params)
         file_id = self._get_file_id(filename, create=create)
@@ -1,5 +1,240 @@
 import numpy as np
 from collections import OrderedDict
+from collections.abc import Sequence
+
+
+def _value_kind(value_type):
+    """Returns the numpy dtype kind for python values of value_type
+    ('O' if numpy would store them as objects).
+
+    """
+    try:
+        return np.dtype(value_type).kind
+    except TypeError:
+        return 'O'
+
+
+def _as_column(values):
+    """Convert values (an array or a sequence of python values) to a
+    numpy array suitable for use as a ResultSet column.  Arrays are
+    passed through without copying.
+
+    Values are stored in a typed array only if they are all of one
+    kind (e.g. all int, or all str), so that they are returned
+    unchanged in .rows.  Otherwise (such as when ints are mixed with
+    floats or bools, or for sequence-valued cells), the column holds
+    the python objects.
+
+    """
+    if isinstance(values, np.ndarray):
+        return values
+    values = list(values)
+    kinds = set([_value_kind(t) for t in set(map(type, values))])
+    if len(kinds) == 1 and 'O' not in kinds:
+        try:
+            column = np.array(values)
+            if column.ndim == 1 and column.dtype.kind in kinds:
+                return column
+        except ValueError:
+            pass
+    # Store as objects.
+    column = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        column[i] = v
+    return column
+
+
+def _columns_from_rows(rows, n_cols):
+    """Transpose a list of row tuples into a list of n_cols columns."""
+    if len(rows) == 0:
+        return [np.zeros(0) for i in range(n_cols)]
+    columns = [_as_column(c) for c in zip(*rows)]
+    if len(columns) != n_cols:
+        raise ValueError(f"Rows have {len(columns)} entries but "
+                         f"{n_cols} keys were specified.")
+    return columns
+
+
+def _concat_columns(columns):
+    """Concatenate a list of columns into a single new array.  Empty
+    columns are ignored, so that the (default) dtype of a column in an
+    empty ResultSet does not affect the output dtype.
+
+    """
+    nonempty = [c for c in columns if len(c)]
+    if len(nonempty) == 0:
+        return columns[0].copy()
+    kinds = set([c.dtype.kind for c in nonempty])
+    if len(kinds) > 1:
+        # Don't let numpy convert the values to a common type.
+        return np.concatenate([c.astype(object) for c in nonempty])
+    return np.concatenate(nonempty)
+
+
+def _column_codes(column):
+    """Returns (codes, n), where codes is an array of integers in
+    range(n) that label the distinct values of column.  The codes
+    follow the sort order of the values, if they can be sorted.
+
+    """
+    try:
+        if column.ndim > 1:
+            _, codes = np.unique(column, axis=0, return_inverse=True)
+        else:
+            _, codes = np.unique(column, return_inverse=True)
+        codes = codes.reshape(-1)
+    except TypeError:
+        # Values can't be ordered (e.g. None with ints).
+        lookup = {}
+        codes = np.array([lookup.setdefault(v, len(lookup))
+                          for v in _column_values(column)], dtype=int)
+    return codes, (codes.max() + 1 if len(codes) else 0)
+
+
+def _group_rows(columns, n, sort=True):
+    """Identify the distinct rows of the table with the given columns
+    (and n rows).  Returns (first, inverse, counts), where first is
+    the index of the first occurrence of each distinct row, inverse
+    gives, for each row, the index of its distinct row in first, and
+    counts is the number of occurrences of each distinct row.
+
+    If sort, the distinct rows are in sorted order (by the first
+    column, then the second, ...); otherwise they are in order of
+    first occurrence.
+
+    """
+    key = np.zeros(n, dtype=int)
+    for column in columns:
+        codes, n_codes = _column_codes(column)
+        # Re-label after each column, to keep the key small.
+        _, key = np.unique(key * n_codes + codes, return_inverse=True)
+        key = key.reshape(-1)
+    _, first, inverse, counts = np.unique(
+        key, return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    if not sort:
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order))
+        first, inverse, counts = first[order], rank[inverse], counts[order]
+    return first, inverse, counts
+
+
+def _take_fill(column, index):
+    """Returns column[index], except that where index is negative the
+    output is set to a missing value: NaN for float columns, '' for
+    string columns, and None otherwise (in which case the output has
+    object dtype).
+
+    """
+    missing = index < 0
+    if len(column) == 0:
+        output = np.zeros((len(index),) + column.shape[1:], column.dtype)
+    else:
+        output = column[np.where(missing, 0, index)]
+    if not np.any(missing):
+        return output
+    if output.dtype.kind in 'fc':
+        output[missing] = np.nan
+    elif output.dtype.kind in 'US':
+        output[missing] = ''
+    else:
+        output = output.astype(object)
+        output[missing] = None
+    return output
+
+
+def _sqlite_dtype(decl_type):
+    """Returns the numpy dtype for values from an sqlite column with
+    declared type decl_type, following the sqlite rules for column
+    affinity; or None if the affinity is NUMERIC or BLOB.
+
+    """
+    decl_type = (decl_type or '').upper()
+    if 'INT' in decl_type:
+        return np.dtype(int)
+    if any([x in decl_type for x in ['CHAR', 'CLOB', 'TEXT']]):
+        return np.dtype(str)
+    if any([x in decl_type for x in ['REAL', 'FLOA', 'DOUB']]):
+        return np.dtype(float)
+    return None
+
+
+def table_dtypes(conn, table):
+    """Returns a dict mapping each column of an sqlite table to the
+    numpy dtype that ResultSet.from_cursor should use for it (or
+    None), based on the declared column types.
+
+    """
+    return {row[1]: _sqlite_dtype(row[2]) for row in
+            conn.execute('pragma table_info(`%s`)' % table).fetchall()}
+
+
+def _typed_column(values, dtype=None):
+    """Convert a sequence of values from sqlite into a column array of
+    type dtype.  If the values are not all of that type (such as when
+    there are NULLs), the type is inferred instead.
+
+    """
+    if dtype is None or None in values:
+        return _as_column(values)
+    if len(values) == 0:
+        return np.zeros(0, dtype=dtype)
+    if dtype.kind == 'i':
+        column = np.array(values)
+        if column.dtype.kind == 'i':
+            return column
+        return _as_column(values)
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return _as_column(values)
+
+
+def _column_values(column):
+    """Returns the entries of column as a list of python objects."""
+    if column.ndim == 1:
+        return column.tolist()
+    return list(column)
+
+
+def _column_value(column, index):
+    """Returns a single entry of column, as a python object if
+    possible.
+
+    """
+    v = column[index]
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+class _RowView(Sequence):
+    """Read-only sequence of row tuples, built on demand from the
+    columns of a ResultSet.
+
+    """
+    def __init__(self, rset):
+        self._rset = rset
+
+    def __len__(self):
+        return len(self._rset)
+
+    def __getitem__(self, index):
+        columns = self._rset._columns()
+        if isinstance(index, slice):
+            return list(zip(*[_column_values(c[index]) for c in columns]))
+        return tuple([_column_value(c, index) for c in columns])
+
+    def __iter__(self):
+        columns = self._rset._columns()
+        return zip(*[_column_values(c) for c in columns])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class ResultSet(object):
@@ -15,8 +250,8 @@ class ResultSet(object):
       >>> print(rset.keys)
       ['array_code', 'freq_code']
 
-    You can request a column by name, and a numpy array of values will
-    be constructed for you:
+    You can request a column by name, and the numpy array of values
+    will be returned (this is not a copy):
 
       >>> rset['array_code']
       array(['LF1', 'LF1', 'LF1', ..., 'LF1', 'LF1', 'LF1'], dtype='<U3')
@@ -27,8 +262,10 @@ class ResultSet(object):
       >>> rset[10]
       {'base.array_code': 'LF1', 'base.freq_code': 'f027'}
 
-    (You can also access the raw row data in .rows, which is a simple
-    list of tuples.)
+    The data are stored internally as one numpy array per column.
+    (You can also access the row data in .rows, which is a read-only
+    sequence of tuples that are built on demand; and the columns in
+    .columns, which is an OrderedDict mapping key to array.)
 
     You can get a structured numpy array using:
 
@@ -49,32 +286,105 @@ class ResultSet(object):
       >>> rset.distinct()
       ResultSet<[array_code,freq_code], 14 rows>
 
+    The distinct rows are in order of first appearance; pass
+    sort=True to get them in sorted order (which was the default in
+    earlier versions).
+
     """
 
     #: Once instantiated, a list of the names of the ResultSet
     #: columns.
     keys = None
 
-    #: Once instantiated, a list of the raw data tuples.
-    rows = None
-
     def __init__(self, keys, src=None):
         self.keys = list(keys)
-        if src is None:
-            self.rows = []
-        else:
-            self.rows = [tuple(x) for x in src]
+        self._cols = [np.zeros(0) for k in self.keys]
+        # Rows added through append(), not yet merged into _cols.
+        self._tail = []
+        if src is not None:
+            self.rows = src
+
+    def _columns(self):
+        """Returns the list of column arrays (in the order of self.keys),
+        after merging in any rows that are pending from append().
+
+        """
+        if len(self._tail):
+            new_cols = _columns_from_rows(self._tail, len(self.keys))
+            self._cols = [_concat_columns([a, b])
+                          for a, b in zip(self._cols, new_cols)]
+            self._tail = []
+        return self._cols
+
+    def _from_columns(self, keys, columns):
+        """Returns a new object of the present class, with the specified
+        keys and column arrays (which are not copied).
+
+        """
+        output = self.__class__(keys)
+        output._cols = list(columns)
+        return output
+
+    @property
+    def rows(self):
+        """A read-only sequence of row tuples.  The tuples are constructed
+        from the column data on demand.  Assigning a list of tuples to
+        this attribute replaces the data.
+
+        """
+        return _RowView(self)
+
+    @rows.setter
+    def rows(self, src):
+        self._cols = _columns_from_rows([tuple(x) for x in src],
+                                        len(self.keys))
+        self._tail = []
+
+    @property
+    def columns(self):
+        """An OrderedDict mapping each key to its column array."""
+        return OrderedDict(zip(self.keys, self._columns()))
+
+    @classmethod
+    def from_columns(cls, columns, keys=None):
+        """Create a ResultSet from column data.
+
+        Arguments:
+          columns: a dict mapping key to array (or sequence) of
+            values; or a list of arrays, in which case keys must also
+            be passed.
+          keys: the list of keys to use.  If columns is a dict, this
+            can be used to select and order the columns.
+
+        Arrays are stored without copying.
+
+        """
+        if keys is None:
+            keys = list(columns.keys())
+        if isinstance(columns, dict):
+            columns = [columns[k] for k in keys]
+        columns = [_as_column(c) for c in columns]
+        if len(columns) != len(keys):
+            raise ValueError("Number of columns does not match number "
+                             "of keys.")
+        if len(set(map(len, columns))) > 1:
+            raise ValueError("Columns have different lengths.")
+        self = cls(keys)
+        self._cols = columns
+        return self
 
     @classmethod
     def from_friend(cls, source):
         if isinstance(source, np.ndarray):
             keys = source.dtype.names # structured array?
-            return cls(keys, list(source))
+            return cls.from_columns([source[k] for k in keys], keys=keys)
         if isinstance(source, ResultSet):
-            return cls(source.keys, source.rows)
+            return cls.from_columns([c.copy() for c in source._columns()],
+                                    keys=source.keys)
 
     def copy(self):
-        return self.__class__(self.keys, self.rows)
+        return self._from_columns(self.keys,
+                                  [c.copy() for c in self._columns()])
 
     def subset(self, keys=None, rows=None):
         """Returns a copy of the object, selecting only the keys and rows
@@ -88,36 +398,64 @@ class ResultSet(object):
             bools, of the same length as self.rows, to select row by
             row.  None keeps all.
 
+        If rows is None, the column arrays of the output are shared
+        with self (rather than copied).
+
         """
+        columns = self._columns()
         if keys is None:
             keys = self.keys
-            def key_sel_func(row):
-                return row
-        else:
-            key_idx = [self.keys.index(k) for k in keys]
-            def key_sel_func(row):
-                return [row[i] for i in key_idx]
-        if rows is None:
-            new_rows = map(key_sel_func, self.rows)
-        elif isinstance(rows, np.ndarray) and rows.dtype == bool:
-            assert(len(rows) == len(self.rows))
-            new_rows = [key_sel_func(r) for r, s in zip(self.rows, rows) if s]
         else:
-            new_rows = [key_sel_func(self.rows[i]) for i in rows]
-        return self.__class__(keys, new_rows)
+            columns = [columns[self.keys.index(k)] for k in keys]
+        if rows is not None:
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                assert(len(rows) == len(self))
+            else:
+                rows = rows.astype(int)
+            columns = [c[rows] for c in columns]
+        return self._from_columns(keys, columns)
 
     @classmethod
-    def from_cursor(cls, cursor, keys=None):
+    def from_cursor(cls, cursor, keys=None, dtypes=None, chunk_size=10000):
 
         """Create a ResultSet using the results stored in cursor, an
         sqlite.Cursor object.  The cursor must have be configured so
         that .description is populated.
 
+        The rows are fetched (as plain tuples, regardless of the
+        cursor's row_factory) chunk_size at a time, and converted to
+        column arrays chunk by chunk.  The types of the columns may
+        be specified with dtypes, which is either a list with a numpy
+        dtype (or None) for each column, or a dict mapping column
+        names (as in cursor.description) to dtypes.  The output of
+        table_dtypes() can be used for this.  Columns that are not
+        typed, or that contain NULLs or other values not matching the
+        type, get the type numpy infers.
+
         """
+        names = [c[0] for c in cursor.description]
         if keys is None:
-            keys = [c[0] for c in cursor.description]
+            keys = names
+        if len(keys) != len(names):
+            raise ValueError("Number of keys does not match number of "
+                             "columns in cursor.")
+        if dtypes is None:
+            dtypes = [None] * len(names)
+        elif isinstance(dtypes, dict):
+            dtypes = [dtypes.get(k) for k in names]
+        cursor.row_factory = None
+        chunks = [[] for k in keys]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            for chunk, dtype, values in zip(chunks, dtypes, zip(*rows)):
+                chunk.append(_typed_column(values, dtype))
         self = cls(keys)
-        self.rows = [tuple(r) for r in cursor]
+        self._cols = [_concat_columns(chunk) if len(chunk) else
+                      _typed_column((), dtype)
+                      for chunk, dtype in zip(chunks, dtypes)]
         return self
 
     def asarray(self, simplify_keys=False):
@@ -131,20 +469,122 @@ class ResultSet(object):
         if simplify_keys:  # remove prefixes
             keys = [k.split('.')[-1] for k in keys]
             assert(len(set(keys)) == len(keys))  # distinct.
-        columns = tuple(map(np.array, zip(*self.rows)))
+        columns = self._columns()
         dtype = [(k, c.dtype, c.shape[1:]) for k, c in zip(keys, columns)]
-        output = np.ndarray(shape=len(columns[0]), dtype=dtype)
+        output = np.empty(len(self), dtype=dtype)
         for k, c in zip(keys, columns):
             output[k] = c
         return output
 
-    def distinct(self):
+    def distinct(self, sort=False, return_inverse=False,
+                 return_counts=False):
         """
         Returns a ResultSet that is a copy of the present one, with
-        duplicates removed.  The rows are sorted (according to python
-        sort).
+        duplicates removed.
+
+        Arguments:
+          sort: if True, the rows are sorted (by the first column,
+            then the second, ...).  Otherwise they are in order of
+            first appearance.
+          return_inverse: if True, also return an array giving, for
+            each row of self, the index of the matching row in the
+            output.
+          return_counts: if True, also return an array with the
+            number of times each output row occurs in self.
+
+        As for np.unique, if either of the return_* options are set
+        then a tuple is returned, starting with the ResultSet.
         """
-        return self.__class__(self.keys, sorted(list(set(self.rows))))
+        first, inverse, counts = _group_rows(self._columns(), len(self),
+                                             sort=sort)
+        output = self.subset(rows=first)
+        if not (return_inverse or return_counts):
+            return output
+        output = (output,)
+        if return_inverse:
+            output += (inverse,)
+        if return_counts:
+            output += (counts,)
+        return output
+
+    def groupby(self, keys, sort=False):
+        """Group the rows of self by the values in the columns named in
+        keys.  Returns (groups, indices), where groups is a ResultSet
+        with the distinct combinations of those values (ordered as in
+        distinct()), and indices is a list of arrays, giving the row
+        indices (into self) of each group.
+        """
+        columns = self.columns
+        first, inverse, counts = _group_rows([columns[k] for k in keys],
+                                             len(self), sort=sort)
+        order = np.argsort(inverse, kind='stable')
+        indices = np.split(order, np.cumsum(counts)[:-1]) if len(first) else []
+        return self.subset(keys=keys, rows=first), indices
+
+    def join(self, other, on, how='inner', suffixes=('_x', '_y')):
+        """Join with another ResultSet, matching rows on the values of key
+        columns.
+
+        Arguments:
+          other: the ResultSet to join with.
+          on: the key, or list of keys, to match on; these must be
+            present in both self and other.
+          how: 'inner', to keep only the rows of self that match a
+            row of other; or 'left', to keep all rows of self.  In
+            the latter case, the columns from other are filled with
+            missing values (NaN, '' or None, depending on the type)
+            for rows of self that have no match.
+          suffixes: a pair of strings, appended to the names of
+            (non-key) columns that are present in both self and other
+            to distinguish them in the output.
+
+        Returns a new object of the present class, with the columns
+        of self followed by the non-key columns of other.  Each row
+        of self appears once for each matching row of other; the
+        output follows the order of self, and then that of other.
+
+        """
+        if isinstance(on, str):
+            on = [on]
+        if how not in ['inner', 'left']:
+            raise ValueError(f'Invalid join type "{how}".')
+        for k in on:
+            if k not in self.keys or k not in other.keys:
+                raise ValueError(f'Join key "{k}" not present in both '
+                                 f'ResultSets.')
+        n1, n2 = len(self), len(other)
+        cols1, cols2 = self.columns, other.columns
+
+        # Label the key combinations, consistently for both sides.
+        _, codes, _ = _group_rows(
+            [_concat_columns([cols1[k], cols2[k]]) for k in on], n1 + n2)
+        left, right = codes[:n1], codes[n1:]
+
+        # Find the range of matching rows in the sorted right side.
+        order = np.argsort(right, kind='stable')
+        start = np.searchsorted(right[order], left, side='left')
+        counts = np.searchsorted(right[order], left, side='right') - start
+        out_counts = counts
+        if how == 'left':
+            out_counts = np.maximum(counts, 1)
+        left_index = np.repeat(np.arange(n1), out_counts)
+        offset = (np.arange(len(left_index)) -
+                  np.repeat(np.cumsum(out_counts) - out_counts, out_counts))
+        matched = np.repeat(counts > 0, out_counts)
+        right_index = np.full(len(left_index), -1)
+        right_index[matched] = order[(np.repeat(start, out_counts) +
+                                      offset)[matched]]
+
+        # Output keys, with suffixes to resolve any collisions.
+        other_keys = [k for k in other.keys if k not in on]
+        clashes = [k for k in other_keys if k in self.keys]
+        keys = ([k + suffixes[0] if k in clashes else k for k in self.keys] +
+                [k + suffixes[1] if k in clashes else k for k in other_keys])
+        if len(set(keys)) != len(keys):
+            raise ValueError(f'Duplicate keys in join output: {keys}')
+        columns = ([cols1[k][left_index] for k in self.keys] +
+                   [_take_fill(cols2[k], right_index) for k in other_keys])
+        return self._from_columns(keys, columns)
 
     def strip(self, patterns=[]):
         """For any keys that start with a string in patterns, remove that
@@ -165,6 +605,13 @@ class ResultSet(object):
 
     # Todo: move this to the right place, too.
     def restrict_dets(self, restriction, detdb=None):
+        """Returns a copy of self, restricted by the 'dets:' keys in
+        restriction (a dict).  For each such key that is also a key of
+        self, only the rows matching the restriction value are kept.
+        Each such key that is not in self is added as a column (at the
+        start), filled with the restriction value.
+
+        """
         # There are 4 classes of keys:
         # - dets:* keys appearing only in restriction
         # - dets:* keys appearing only in self
@@ -178,18 +625,15 @@ class ResultSet(object):
                 new_keys.remove(k)
         other_keys = [k for k in self.keys if k not in match_keys]
         output_keys = new_keys + match_keys + other_keys # disjoint.
-        output_rows = []
-        for row in self:
-            row = dict(row)  # copy
-            for k in match_keys:
-                if row[k] != restriction[k]:
-                    break
-            else:
-                # You passed.
-                row.update({k: restriction[k] for k in new_keys})
-            output_rows.append([row[k] for k in output_keys])
+        columns = self.columns
+        mask = np.ones(len(self), bool)
+        for k in match_keys:
+            np.logical_and(mask, columns[k] == restriction[k], out=mask)
+        n = np.count_nonzero(mask)
+        output_cols = ([np.full(n, restriction[k]) for k in new_keys] +
+                       [columns[k][mask] for k in match_keys + other_keys])
         # That's all.
-        return self.__class__(output_keys, output_rows)
+        return self._from_columns(output_keys, output_cols)
 
     # Everything else is just implementing container-like behavior
 
@@ -201,7 +645,14 @@ class ResultSet(object):
                                            keystr, len(self)))
 
     def __len__(self):
-        return len(self.rows)
+        if len(self._cols) == 0:
+            return len(self._tail)
+        return len(self._cols[0]) + len(self._tail)
+
+    def __iter__(self):
+        keys = self.keys
+        for row in self.rows:
+            yield OrderedDict(zip(keys, row))
 
     def append(self, item):
         vals = []
@@ -209,7 +660,7 @@ class ResultSet(object):
             if k not in item.keys():
                 raise ValueError(f"Item to append must include key '{k}'")
             vals.append(item[k])
-        self.rows.append(tuple(vals))
+        self._tail.append(tuple(vals))
 
     def extend(self, items):
         if not isinstance(items, ResultSet):
@@ -217,20 +668,21 @@ class ResultSet(object):
         if self.keys != items.keys:
             raise ValueError("Keys do not match: {} <- {}".format(
                 self.keys, items.keys))
-        self.rows.extend(items.rows)
+        self._cols = [_concat_columns([a, b]) for a, b in
+                      zip(self._columns(), items._columns())]
 
     def __getitem__(self, item):
+        columns = self._columns()
         # Simple row look-up... convert to dict.
-        if isinstance(item, int):
-            return OrderedDict([(k,v) for k, v in
-                                zip(self.keys, self.rows[item])])
+        if isinstance(item, (int, np.integer)):
+            return OrderedDict([(k, _column_value(c, item))
+                                for k, c in zip(self.keys, columns)])
         # Look-up by column...
         if isinstance(item, str):
             index = self.keys.index(item)
-            return np.array([x[index] for x in self.rows])
+            return columns[index]
         # Slicing.
-        output = self.__class__(self.keys, self.rows[item])
-        return output
+        return self._from_columns(self.keys, [c[item] for c in columns])
 
     def __iadd__(self, other):
         self.extend(other)
@@ -243,15 +695,27 @@ class ResultSet(object):
 
     @staticmethod
     def concatenate(items, axis=0):
+        """Returns a new object, of the same class as items[0], containing
+        the rows of all the ResultSets in items (which must have the
+        same keys), in order.  Each output column is allocated once.
+
+        """
         assert(axis == 0)
-        output = items[0].copy()
         for item in items[1:]:
-            output += item
-        return output
+            if not isinstance(item, ResultSet):
+                raise TypeError("Concatenation only valid for ResultSet "
+                                "objects.")
+            if item.keys != items[0].keys:
+                raise ValueError("Keys do not match: {} <- {}".format(
+                    items[0].keys, item.keys))
+        columns = [_concat_columns(list(cols)) for cols in
+                   zip(*[item._columns() for item in items])]
+        return items[0]._from_columns(items[0].keys, columns)
 
     def merge(self, src):
         """Merge with src, which must have same number of rows as self.
-        Duplicate columns are not allowed.
+        Duplicate columns are not allowed.  The column arrays of src
+        are shared, not copied.
 
         """
         if len(self) != len(src):
@@ -259,6 +723,5 @@ class ResultSet(object):
         for k in src.keys:
             if k in self.keys:
                 raise ValueError("Duplicate key: %s" % k)
-        new_keys = self.keys + src.keys
-        new_rows = [r0 + r1 for r0, r1 in zip(self.rows, src.rows)]
-        self.keys, self.rows = new_keys, new_rows
+        self._cols = self._columns() + src._columns()
+        self.keys = self.keys + src.keys
@@ -14,18 +14,340 @@ http://docs.h5py.org/en/stable/strings.html for a little more info.
 """
 
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
 import h5py
 import contextlib
+import os
+import threading
+from collections import OrderedDict
 
 from .resultset import ResultSet
 
 
+class DatasetCache:
+    """LRU cache of open HDF5 files, and of the (prefiltered) datasets
+    read from them.  A single instance, simple.dataset_cache, is
+    shared by all loaders in the process.
+
+    Datasets are keyed on (path, dataset, mtime) (and on the file size
+    and prefilter function), so a file that is rewritten is read again
+    on the next request.  The total size of the cached arrays is kept
+    below max_bytes by discarding the least recently used ones;
+    arrays larger than that are never cached.  By default, files are
+    closed after each read, so that they can be opened for writing
+    (by this or other processes).  Pass max_files > 0 to hold up to
+    that many files open between reads; in that case call
+    invalidate() to release a file before writing to it.
+
+    Files are read without holding the cache lock, so different
+    datasets can be loaded concurrently from several threads;
+    concurrent requests for the same dataset wait for a single read.
+
+    The cached arrays are shared between callers, and must not be
+    modified.
+
+    """
+    def __init__(self, max_bytes=2**28, max_files=0):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._files = OrderedDict()
+        self._users = {}
+        self._data = OrderedDict()
+        self._attrs = {}
+        self._pending = {}
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _stat(filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        return path, (st.st_mtime_ns, st.st_size)
+
+    def get_file(self, filename):
+        """Context manager providing an open (read-only) h5py.File for
+        filename, e.g.::
+
+          with dataset_cache.get_file(filename) as fin:
+              ...
+
+        The File is not closed by other threads during the block, and
+        is released on exit (closed, unless max_files > 0).  It should
+        not be closed by the caller.
+
+        """
+        path, version = self._stat(filename)
+        return self._open(path, version)
+
+    def _get_file(self, path, version):
+        item = self._files.get(path)
+        if item is not None:
+            if item[0] == version:
+                self._files.move_to_end(path)
+                return item[1]
+            self._close(path)
+        fin = h5py.File(path, mode='r')
+        self._files[path] = (version, fin)
+        while len(self._files) > max(self.max_files, 1):
+            self._close(next(iter(self._files)))
+        return fin
+
+    def _close(self, path):
+        # Files in use by a reader are closed when it releases them.
+        _, fin = self._files.pop(path)
+        if id(fin) not in self._users:
+            fin.close()
+
+    @contextlib.contextmanager
+    def _open(self, path, version):
+        """Context manager providing the h5py.File for path, protected
+        from being closed by other threads until the block exits.  The
+        lock is not held in the block.
+
+        """
+        with self._lock:
+            fin = self._get_file(path, version)
+            self._users[id(fin)] = self._users.get(id(fin), 0) + 1
+        try:
+            yield fin
+        finally:
+            with self._lock:
+                self._users[id(fin)] -= 1
+                if self._users[id(fin)] == 0:
+                    del self._users[id(fin)]
+                    held = self._files.get(path, (None, None))[1] is fin
+                    if held and self.max_files <= 0:
+                        self._close(path)
+                    elif not held:
+                        fin.close()
+
+    def get(self, filename, dataset, prefilter=None, rows=None, **kwargs):
+        """Return the contents of dataset in HDF5 file filename, as a
+        numpy array.  If prefilter is not None, it is applied to the
+        array (with any additional keyword arguments) and its output
+        is returned (and cached) instead.  If rows is not None, it
+        must be a tuple (start, stop), and only that range of rows is
+        read.
+
+        """
+        path, version = self._stat(filename)
+        key = ((path, dataset) + version +
+               (rows, prefilter, tuple(sorted(kwargs.items()))))
+        while True:
+            with self._lock:
+                if key in self._data:
+                    self._stats['hits'] += 1
+                    self._data.move_to_end(key)
+                    return self._data[key]
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._stats['misses'] += 1
+                    pending = self._pending[key] = threading.Event()
+                    break
+            # Another thread is reading this dataset; wait for it.
+            pending.wait()
+        try:
+            with self._open(path, version) as fin:
+                if rows is None:
+                    data = fin[dataset][()]
+                else:
+                    data = fin[dataset][rows[0]:rows[1]]
+            if prefilter is not None:
+                data = prefilter(data, **kwargs)
+            with self._lock:
+                if data.nbytes <= self.max_bytes:
+                    self._data[key] = data
+                    self._bytes += data.nbytes
+                    self._evict()
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+        return data
+
+    def get_attr(self, filename, dataset, name, default=None):
+        """Return the attribute name of dataset in HDF5 file filename,
+        or default if it is not set.  The values are cached along
+        with the datasets.
+
+        """
+        path, version = self._stat(filename)
+        key = (path, dataset) + version + (name, )
+        with self._lock:
+            if key in self._attrs:
+                value = self._attrs[key]
+                return default if value is None else value
+        with self._open(path, version) as fin:
+            value = fin[dataset].attrs.get(name)
+        with self._lock:
+            if self.max_bytes > 0:
+                self._attrs[key] = value
+        return default if value is None else value
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            _, data = self._data.popitem(last=False)
+            self._bytes -= data.nbytes
+            self._stats['evictions'] += 1
+
+    def invalidate(self, filename=None):
+        """Discard the cached datasets for filename, and close the file.
+        If filename is None, empty the cache entirely.
+
+        """
+        with self._lock:
+            if filename is None:
+                paths = list(self._files.keys())
+                self._data.clear()
+                self._attrs.clear()
+                self._bytes = 0
+            else:
+                paths = [os.path.abspath(filename)]
+                for key in [k for k in self._data if k[0] == paths[0]]:
+                    self._bytes -= self._data.pop(key).nbytes
+                for key in [k for k in self._attrs if k[0] == paths[0]]:
+                    del self._attrs[key]
+            for path in paths:
+                if path in self._files:
+                    self._close(path)
+
+    def cache_info(self):
+        """Returns a dict with the number of cache 'hits', 'misses' and
+        'evictions' so far, and the current number of cached
+        'datasets', their total size in 'bytes', and the number of
+        open 'files'.
+
+        """
+        with self._lock:
+            return dict(self._stats, datasets=len(self._data),
+                        bytes=self._bytes, files=len(self._files))
+
+
+#: The DatasetCache used by PerDetectorHdf5 to load datasets.  Set
+#: max_bytes=0 to disable caching of the loaded data.
+dataset_cache = DatasetCache()
+
+
+def _encode_strings(data):
+    """Returns a copy of structured array data in which any "unicode"
+    string fields have been converted to a numpy fixed-length 'S'
+    type.  This will choke if the strings are not ascii-compatible.
+
+    """
+    new_dtype = []
+    for k in data.dtype.names:
+        if data.dtype[k].char == 'U':
+            max_len = max(np.char.str_len(data[k]).max(initial=0), 1)
+            new_dtype.append((k, 'S%i' % max_len))
+        else:
+            new_dtype.append((k, data.dtype[k]))
+    return data.astype(np.dtype(new_dtype))
+
+
+def _common_dtype(dtype1, dtype2):
+    """Returns a structured dtype that can hold the data of both dtype1
+    and dtype2, which must have the same field names.  String fields
+    are widened as needed.
+
+    """
+    if dtype1.names != dtype2.names:
+        raise ValueError(f'Cannot combine data with fields {dtype2.names} '
+                         f'and {dtype1.names}.')
+    return np.dtype([(k, dtype1[k] if dtype1[k] == dtype2[k]
+                      else np.result_type(dtype1[k], dtype2[k]))
+                     for k in dtype1.names])
+
+
+def _create_dataset(fout, address, data, resizable=False, chunks=None,
+                    compression=None, compression_opts=None):
+    """Create a dataset from data.  If resizable, the dataset is chunked
+    (even if chunks=None) and may be extended with _extend_dataset.
+
+    """
+    kwargs = {}
+    if resizable:
+        kwargs['maxshape'] = (None,) + data.shape[1:]
+        if chunks is None:
+            chunks = True
+    return fout.create_dataset(address, data=data, chunks=chunks,
+                               compression=compression,
+                               compression_opts=compression_opts, **kwargs)
+
+
+def _replace_dataset(fout, address, data, chunks=None, compression=None,
+                     compression_opts=None):
+    """Replace the dataset at address with a resizable dataset holding
+    data.  The attributes, and the compression settings (unless
+    specified), of the original dataset are kept.
+
+    """
+    dset = fout[address]
+    if compression is None:
+        compression = dset.compression
+        compression_opts = dset.compression_opts
+    attrs = dict(dset.attrs)
+    del fout[address]
+    dset = _create_dataset(fout, address, data, resizable=True,
+                           chunks=chunks, compression=compression,
+                           compression_opts=compression_opts)
+    dset.attrs.update(attrs)
+    return dset
+
+
+def _extend_dataset(fout, address, data, **kwargs):
+    """Append the rows of data to an existing dataset.  If the dataset
+    is not resizable, or its fields are too narrow for the new data,
+    it is first rewritten as a resizable dataset (see
+    _replace_dataset, to which kwargs are passed).
+
+    """
+    dset = fout[address]
+    dtype = _common_dtype(dset.dtype, data.dtype)
+    if dtype != dset.dtype or dset.maxshape[0] is not None:
+        # h5py cannot change the type or the maxshape of a dataset.
+        dset = _replace_dataset(fout, address, dset[()].astype(dtype),
+                                **kwargs)
+    n = len(dset)
+    dset.resize((n + len(data),) + dset.shape[1:])
+    dset[n:] = data.astype(dtype)
+    return dset
+
+
+def _make_obs_index(data, keys):
+    """Sort structured array data by the fields listed in keys, and
+    build an index of the row range covered by each distinct
+    combination of their values.  Returns (sorted data, index), where
+    the index is a structured array with fields keys + ['start',
+    'stop'].
+
+    """
+    order = np.lexsort([data[k] for k in keys[::-1]])
+    data = data[order]
+    change = np.zeros(len(data), bool)
+    change[:1] = True
+    for k in keys:
+        change[1:] |= (data[k][1:] != data[k][:-1])
+    starts = change.nonzero()[0]
+    stops = np.append(starts[1:], len(data))
+    dtype = [(k, data.dtype[k]) for k in keys] + [('start', int),
+                                                   ('stop', int)]
+    index = np.empty(len(starts), dtype=dtype)
+    for k in keys:
+        index[k] = data[k][starts]
+    index['start'] = starts
+    index['stop'] = stops
+    return data, index
+
+
 class _Hdf5Writer:
     """This class is a light extension for ResultSet that can write the
     data to an HDF5 file as a dataset.
 
     """
-    def write_dataset(self, filename, address, overwrite=False, mode='a'):
+    def write_dataset(self, filename, address, overwrite=False, mode='a',
+                      index_obs=False, append=False, chunks=None,
+                      compression=None, compression_opts=None):
         """Write self (a ResultSet or similar) to an HDF5 file as a single
         dataset.
 
@@ -38,9 +360,27 @@ class _Hdf5Writer:
             the specified address.
           mode: The mode specification used for opening the file
             (ignored if filename is an open file).
+          index_obs: If true, sort the rows by the 'obs:' columns, and
+            write an index of the rows for each distinct combination
+            of their values to a second dataset, at address +
+            '_obs_index'.  This permits readers to load only the rows
+            for a particular observation.
+          append: If true, create a resizable dataset; or, if the
+            dataset already exists, add the rows of self to it (see
+            below).
+          chunks, compression, compression_opts: Passed to
+            h5py.File.create_dataset, to control the storage layout.
+
+        When appending to an existing dataset, the fields must match
+        those of self.  String fields are widened as needed, and the
+        obs index (if the dataset has one) is extended.  Widening the
+        strings, or adding rows for observations that are already in
+        the index, requires the dataset to be rewritten.
 
         """
         if isinstance(filename, str):
+            # Release any cached handle before opening for write.
+            dataset_cache.invalidate(filename)
             context = h5py.File(filename, mode)
         else:
             # Wrap in a nullcontext so that the block below doesn't
@@ -49,27 +389,65 @@ class _Hdf5Writer:
             filename = fout.filename
             context = contextlib.nullcontext(fout)
 
+        opts = {'chunks': chunks, 'compression': compression,
+                'compression_opts': compression_opts}
         with context as fout:
-            if address in fout:
+            data = _encode_strings(self.asarray())
+            if append and address in fout and not overwrite:
+                self._append_dataset(fout, address, data, opts)
+                return
+            index_address = address + '_obs_index'
+            for addr in [address, index_address]:
+                if addr not in fout:
+                    continue
                 if overwrite:
-                    del fout[address]
-                else:
+                    del fout[addr]
+                elif addr == address:
                     raise RuntimeError(
                         f'Address {address} already exists in {filename}; '
                         f'pass overwrite=True to clobber it.')
-            data = self.asarray()
-            # If there are "unicode" strings in there, convert to a
-            # numpy fixed-length 'S' type.  This will choke if the
-            # strings are not ascii-compatible.
-            new_dtype = []
-            for k in data.dtype.names:
-                if data.dtype[k].char == 'U':
-                    max_len = max(map(len, data[k]))
-                    new_dtype.append((k, 'S%i' % max_len))
-                else:
-                    new_dtype.append((k, data.dtype[k]))
-            data = data.astype(np.dtype(new_dtype))
-            fout.create_dataset(address, data=data)
+            ex_keys = [k for k in data.dtype.names if k.startswith('obs:')]
+            if index_obs and len(ex_keys):
+                if index_address in fout:
+                    raise RuntimeError(
+                        f'Address {index_address} already exists in '
+                        f'{filename}; pass overwrite=True to clobber it.')
+                data, index = _make_obs_index(data, ex_keys)
+                _create_dataset(fout, index_address, index, resizable=append)
+            dset = _create_dataset(fout, address, data, resizable=append,
+                                   **opts)
+            if index_obs and len(ex_keys):
+                dset.attrs['obs_index'] = index_address
+
+    @staticmethod
+    def _append_dataset(fout, address, data, opts):
+        """Append data (a structured array) to the existing dataset at
+        address, updating its obs index if it has one.
+
+        """
+        index_address = fout[address].attrs.get('obs_index')
+        if index_address is None:
+            _extend_dataset(fout, address, data, **opts)
+            return
+        old_index = fout[index_address][()]
+        ex_keys = [k for k in old_index.dtype.names if k.startswith('obs:')]
+        data, index = _make_obs_index(data, ex_keys)
+        old_obs = set(old_index[ex_keys].tolist())
+        if any(obs in old_obs for obs in index[ex_keys].tolist()):
+            # Re-sort everything.
+            old_data = fout[address][()]
+            dtype = _common_dtype(old_data.dtype, data.dtype)
+            data, index = _make_obs_index(
+                np.concatenate([old_data.astype(dtype), data.astype(dtype)]),
+                ex_keys)
+            _replace_dataset(fout, index_address, index)
+            _replace_dataset(fout, address, data, **opts)
+            return
+        n = len(fout[address])
+        index['start'] += n
+        index['stop'] += n
+        _extend_dataset(fout, index_address, index)
+        _extend_dataset(fout, address, data, **opts)
 
 
 class PerDetectorHdf5(ResultSet, _Hdf5Writer):
@@ -82,25 +460,26 @@ class PerDetectorHdf5(ResultSet, _Hdf5Writer):
     intrinsic_axes = ['dets']
 
     @classmethod
-    def _prefilter_data(cls, data_in, key_map={}):
+    def _prefilter_data(cls, data_in, key_map={}, decode=True):
         """This function is called by the data loader, after loading a dataset
         but before matching the indices.  It should always be called,
         to convert numpy 'S'-type to numpy 'U'-type strings.
 
-        Only the positional arguments are passed in by the data
-        loader.  The keyword arguments can be used by subclasses
-        (through super()._prefilter_data(...)).
+        Only the positional arguments, and decode (if False), are
+        passed in by the data loader.  The other keyword arguments can
+        be used by subclasses (through super()._prefilter_data(...)).
 
         If key_map is passed in, it will be used to rename columns
-        (from key to value).
+        (from key to value).  If decode is False, 'S'-type columns are
+        left as they are.
 
         """
         new_dtype = []
         columns = []
         for i, k in enumerate(data_in.dtype.names):
-            if data_in.dtype[k].char == 'S':
-                # Convert to unicode.
-                columns.append(np.array([v.decode('ascii') for v in data_in[k]]))
+            if decode and data_in.dtype[k].char == 'S':
+                # Convert to unicode (this raises if not ascii).
+                columns.append(data_in[k].astype('U'))
             else:
                 columns.append(data_in[k])
             if len(data_in[k].shape) == 1:
@@ -113,10 +492,22 @@ class PerDetectorHdf5(ResultSet, _Hdf5Writer):
             output[k] = c
         return output
 
+    @staticmethod
+    def _match(column, value):
+        """Returns a mask of the elements of column equal to value.
+        Strings are encoded for comparison to 'S'-type columns.
+
+        """
+        if column.dtype.char == 'S' and isinstance(value, str):
+            value = value.encode('ascii')
+        return column == value
+
     @classmethod
     def from_loadspec(cls, load_params,
                       detdb=None,
-                      obsdb=None):
+                      obsdb=None,
+                      as_array=False,
+                      decode=True):
 
         """Retrieve a metadata result.
 
@@ -124,6 +515,10 @@ class PerDetectorHdf5(ResultSet, _Hdf5Writer):
           load_params: an index dictionary (see below).
           detdb: a DetDB which may be used to resolve 'dets' indices.
           obsdb: an ObsDB which may be used to resolve 'obs' indices.
+          as_array: if True, return a numpy structured array instead.
+          decode: if False, string columns are returned as byte
+            strings (numpy 'S' type), skipping the conversion to
+            unicode.
 
         Returns an object of the present class.
 
@@ -138,19 +533,60 @@ class PerDetectorHdf5(ResultSet, _Hdf5Writer):
 
         """
         return cls.batch_from_loadspec(
-            [load_params], detdb=detdb, obsdb=obsdb)[0]
+            [load_params], detdb=detdb, obsdb=obsdb, as_array=as_array,
+            decode=decode)[0]
 
     @classmethod
-    def batch_from_loadspec(cls, load_params, detdb=None, obsdb=None):
+    def _get_obs_rows(cls, filename, dataset, load_params):
+        """If the dataset has an obs index (see write_dataset), use it to
+        look up the range of rows that match the 'obs:' values in
+        load_params, and return it as a tuple (start, stop).
+        Otherwise return None.
+
+        """
+        index_address = dataset_cache.get_attr(filename, dataset,
+                                               'obs_index')
+        if index_address is None:
+            return None
+        index = dataset_cache.get(filename, index_address,
+                                  cls._prefilter_data)
+        mask = np.ones(len(index), bool)
+        for k in index.dtype.names:
+            if k.startswith('obs:'):
+                if k not in load_params:
+                    # Full read; the mask code will complain.
+                    return None
+                np.logical_and(mask, cls._match(index[k], load_params[k]),
+                               out=mask)
+        i = mask.nonzero()[0]
+        if len(i) == 0:
+            return (0, 0)
+        return (int(index['start'][i[0]]), int(index['stop'][i[0]]))
+
+    @classmethod
+    def batch_from_loadspec(cls, load_params, detdb=None, obsdb=None,
+                            as_array=False, decode=True):
         """Retrieve a batch of metadata results.  The arguments here are the
         same as for from_loadspec, expect that load_params must be a
         /list/ of index dictionaries.  This function returns a list of
         objects, corresponding to the elements of load_params.
 
+        If as_array is True, each result is a numpy structured array
+        (the selected rows of the dataset, without the 'obs:'
+        columns) rather than an object of the present class.
+
         This function is relatively efficient in the case that many
-        requests are made for data from a single file.
+        requests are made for data from a single file.  Datasets are
+        loaded through simple.dataset_cache, so repeated requests for
+        the same dataset (across calls) do not reread the file.  If
+        the dataset was written with an obs index (see
+        write_dataset), only the rows for the requested observation
+        are read.
 
         """
+        # Only pass decode if needed, for subclasses that override
+        # _prefilter_data without it.
+        prefilter_kw = {} if decode else {'decode': False}
         # Gather all relevant HDF5 files.
         file_map = {}
         for idx, load_par in enumerate(load_params):
@@ -158,44 +594,50 @@ class PerDetectorHdf5(ResultSet, _Hdf5Writer):
             if fn not in file_map:
                 file_map[fn] = []
             file_map[fn].append(idx)
-        # Open each one and pull out the result.
+        # Load from each one and pull out the result.
         results = [None] * len(load_params)
         for filename, indices in file_map.items():
-            with h5py.File(filename, mode='r') as fin:
-                # Don't reread dataset unless it changes.
-                last_dataset = None
-                for idx in indices:
-                    dataset = load_params[idx]['dataset']
-                    if dataset is not last_dataset:
-                        data = fin[dataset][()]
-                        data = cls._prefilter_data(data)
-                        last_dataset = dataset
-
-                    # Dereference the extrinsic axis request.  Every
-                    # extrinsic axis key in the dataset must have a
-                    # value specified in load_params.
-                    ex_keys = []
-                    mask = np.ones(len(data), bool)
-                    for k in data.dtype.names:
-                        if k.startswith('obs:'):
-                            ex_keys.append(k)
-                            mask *= (data[k] == load_params[idx][k])
-
-                    # Has user made an intrinsic request as well?
-                    for k in data.dtype.names:
-                        if k.startswith('dets:') and k in load_params[idx]:
-                            mask *= (data[k] == load_params[idx][k])
-
-                    # TODO: handle non-concordant extrinsic /
-                    # intrinsic requests.
-
-                    # Output.
-                    keys_out = [k for k in data.dtype.names
-                                if k not in ex_keys]
-                    self = cls(keys=keys_out)
-                    for i in mask.nonzero()[0]:
-                        self.append({k: data[k][i] for k in self.keys})
-                    results[idx] = self
+            # Don't refetch dataset unless it changes.
+            last_dataset = None
+            for idx in indices:
+                dataset = load_params[idx]['dataset']
+                rows = cls._get_obs_rows(filename, dataset, load_params[idx])
+                if (dataset, rows) != last_dataset:
+                    data = dataset_cache.get(filename, dataset,
+                                             cls._prefilter_data,
+                                             rows=rows, **prefilter_kw)
+                    last_dataset = (dataset, rows)
+
+                # Dereference the extrinsic axis request.  Every
+                # extrinsic axis key in the dataset must have a
+                # value specified in load_params.
+                ex_keys = []
+                mask = np.ones(len(data), bool)
+                for k in data.dtype.names:
+                    if k.startswith('obs:'):
+                        ex_keys.append(k)
+                        np.logical_and(
+                            mask, cls._match(data[k], load_params[idx][k]),
+                            out=mask)
+
+                # Has user made an intrinsic request as well?
+                for k in data.dtype.names:
+                    if k.startswith('dets:') and k in load_params[idx]:
+                        np.logical_and(
+                            mask, cls._match(data[k], load_params[idx][k]),
+                            out=mask)
+
+                # TODO: handle non-concordant extrinsic /
+                # intrinsic requests.
+
+                # Output.
+                keys_out = [k for k in data.dtype.names
+                            if k not in ex_keys]
+                if as_array:
+                    results[idx] = repack_fields(data[mask][keys_out])
+                else:
+                    results[idx] = cls.from_columns(
+                        [data[k][mask] for k in keys_out], keys=keys_out)
         return results
 
     @classmethod
@@ -1,6 +1,8 @@
 import unittest
 import sotoddb
+from sotoddb import dbio
 
+import io
 import os
 import time
 
@@ -83,9 +85,116 @@ class TestDetDb(unittest.TestCase):
             dt = time.time() - t0
             print('  -- read-back {} rows in {} seconds.'.format(
                 len(db1.dets()), dt))
+            self.assertEqual(len(db1.dets()), len(db0.dets()))
             print('  -- removing.')
             os.remove(fn)
 
+    def test_bulk(self):
+        """Check add_props_bulk."""
+        db = sotoddb.DetDB()
+        db.create_table('base', ["`band` varchar(16)", "`x` float"])
+        db.add_props('base', 'det1', band='f090', x=1.,
+                     time_range=(0, 100))
+        data = {'name': ['det2', 'det1', 'det0', 'det2'],
+                'time0': [0, 100, 0, 200],
+                'time1': [100, 200, 200, 300],
+                'band': ['f150', 'f090', 'f150', 'f090'],
+                'x': [2., 1., 0., 2.]}
+        db.add_props_bulk('base', data, check_intervals=True)
+        db.validate()
+        self.assertEqual(list(db.dets()['name']), ['det1', 'det2', 'det0'])
+        props = db.props(['det2'], props=['band'])
+        self.assertEqual(sorted(props['band']), ['f090', 'f150'])
+        # Structured array input; overlaps with existing det1 row.
+        rset = sotoddb.ResultSet(['name', 'band', 'x'],
+                                 [('det3', 'f150', 3.), ('det1', 'f090', 1.)])
+        for bad in [rset, rset.asarray()]:
+            with self.assertRaises(sotoddb.detdb.IntervalError):
+                db.add_props_bulk('base', bad, check_intervals=True)
+        self.assertEqual(len(db), 3)
+        # Negative and self-overlapping intervals.
+        for t0, t1 in [([300], [250]), ([400, 450], [500, 550])]:
+            with self.assertRaises(sotoddb.detdb.IntervalError):
+                db.add_props_bulk('base', {'name': ['det0'] * len(t0),
+                                           'time0': t0, 'time1': t1,
+                                           'band': ['x'] * len(t0),
+                                           'x': [0.] * len(t0)},
+                                  check_intervals=True)
+
+    def test_timestamps(self):
+        """Check time-resolved property lookup."""
+        db = sotoddb.DetDB()
+        db.create_table('base', ["`band` varchar(16)"])
+        db.create_table('cal', ["`gain` float"])
+        db.add_props_bulk('base', {'name': ['d0', 'd1', 'd2', 'd1'],
+                                   'time0': [0, 0, 50, 100],
+                                   'time1': [200, 100, 150, 200],
+                                   'band': ['a', 'b', 'c', 'd']})
+        db.add_props_bulk('cal', {'name': ['d0', 'd0', 'd1', 'd2'],
+                                  'time0': [0, 100, 20, 0],
+                                  'time1': [100, 300, 200, 200],
+                                  'gain': [1., 2., 3., 4.]})
+        snap = db.snapshot(['base.band', 'cal.gain'])
+        times = [-1, 0, 10, 20, 50, 99.5, 100, 149, 150, 199, 200]
+        dets = ['d2', 'd0', 'x', 'd1']
+        results = snap.props(dets, times)
+        self.assertEqual(results.keys, ['name', 'timestamp', 'band',
+                                        'cal.gain'])
+        n = 0
+        for t in times:
+            ref = db.props(dets, timestamp=t, props=['band', 'cal.gain'])
+            sub = results.subset(rows=results['timestamp'] == t)
+            self.assertEqual(sorted(ref.rows),
+                             sorted(sub.subset(keys=ref.keys).rows))
+            n += len(ref)
+        self.assertEqual(len(results), n)
+        self.assertEqual(list(results['name'][:2]), ['d2', 'd2'])
+        self.assertEqual(len(snap.props(['x'], 10.)), 0)
+        with self.assertRaises(ValueError):
+            snap.props(dets)
+        # An empty interval with the same time0 as a real one.
+        db.add_props_bulk('base', {'name': ['d3', 'd3'], 'time0': [0, 0],
+                                   'time1': [100, 0], 'band': ['e', 'f']})
+        db.validate()
+        snap = db.snapshot(['base.band'])
+        self.assertEqual(list(db.props(['d3'], timestamp=50,
+                                       props=['band']).rows), [('e',)])
+        self.assertEqual(list(snap.props(['d3'], 50).rows),
+                         [('d3', 50., 'e')])
+
+    def test_indexes(self):
+        """Check that property tables are indexed."""
+        db = sotoddb.DetDB()
+        db.create_table('base', ["`band` varchar(16)"], index_props=['band'])
+        db.conn.execute('create table `extra` (`det_id` integer, '
+                        '`time0` integer, `time1` integer, `x` float)')
+        q, args = db.get_dets_query(timestamp=10., props={'extra.x': 1.})
+        assert not any('USING INDEX' in p for p in db.explain(q, args))
+        db.ensure_indexes(props=['extra.x'])
+        assert any('idx_extra_x' in p for p in db.explain(q, args))
+        q, args = db.get_dets_query(props={'band': 'f090'})
+        assert any('idx_base_band' in p for p in db.explain(q, args))
+        indexes = [r[0] for r in db.conn.execute(
+            "select name from sqlite_master where type='index'")]
+        for t in ['base', 'extra']:
+            assert f'idx_{t}_det_id_time0_time1' in indexes
+
+    def test_dump_stream(self):
+        """Check statement parsing for streamed dump restore."""
+        db0 = sotoddb.DetDB()
+        db0.create_table('base', ["`note` varchar(32)"])
+        db0.add_props('base', 'det;0', note='a;b\n;')
+        db0.add_props('base', 'det1', note="it's;")
+        # Legacy dumps did not separate statements with newlines.
+        text = ''.join(db0.conn.iterdump())
+        statements = list(dbio.iter_statements(io.StringIO(text),
+                                               chunk_size=7))
+        self.assertEqual(len(statements), len(list(db0.conn.iterdump())))
+        db1 = sotoddb.DetDB(init_db=False)
+        dbio.restore_dump(db1.conn, io.StringIO(text), batch_size=2)
+        self.assertEqual(list(db1.props()['note']), ['a;b\n;', "it's;"])
+        self.assertEqual(list(db1.dets()['name']), ['det;0', 'det1'])
+
 
 if __name__ == '__main__':
     unittest.main()
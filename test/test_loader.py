@@ -0,0 +1,90 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from sotoddb import loader, proddb, simple
+
+
+class TestSuperLoader(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        scheme = proddb.ManifestScheme()
+        scheme.add_exact_match('obs:obs_id')
+        scheme.add_data_field('dataset')
+        man = proddb.ManifestDB(scheme=scheme)
+        for f in range(4):
+            filename = 'f%i.h5' % f
+            for i in range(3):
+                obs_id = 'obs%i' % i
+                rs = simple.PerDetectorHdf5(
+                    keys=['dets:name', 'cal'],
+                    src=[('d%i_%i' % (f, j), i + j * .1) for j in range(5)])
+                rs.write_dataset(os.path.join(self.test_dir, filename),
+                                 obs_id)
+                man.add_entry({'obs:obs_id': obs_id, 'dataset': obs_id},
+                              filename, commit=False)
+        self.db = os.path.join(self.test_dir, 'man.sqlite')
+        man.copy(self.db)
+        self.spec = {'db': self.db, 'name': ['cal&']}
+
+    def tearDown(self):
+        simple.dataset_cache.invalidate()
+        shutil.rmtree(self.test_dir)
+
+    def test_load_raw(self):
+        sl = loader.SuperLoader()
+        (unpackers, ref), = sl.load_raw([self.spec], {'obs:obs_id': 'obs1'})
+        self.assertEqual(len(ref), 20)
+        self.assertEqual(ref.rows[6], ('d1_1', 1.1))
+        for workers in [2, 8]:
+            (_, result), = loader.SuperLoader(workers=workers).load_raw(
+                [self.spec], {'obs:obs_id': 'obs1'})
+            self.assertEqual(list(result.rows), list(ref.rows))
+        (_, result), = sl.load_raw([self.spec], {'obs:obs_id': 'obs1'},
+                                   workers=3)
+        self.assertEqual(list(result.rows), list(ref.rows))
+
+    def test_load_many(self):
+        class Loader(loader.SuperLoader):
+            # Use sotodlib's ManifestDb, which lacks match_many.
+            def _open_manifest(self, dbfile):
+                return loader.core.metadata.ManifestDb.from_file(dbfile)
+
+        assert hasattr(loader.SuperLoader()._open_manifest(self.db),
+                       'match_many')
+
+        requests = [{'obs:obs_id': 'obs%i' % i} for i in [2, 0, 1, 0]]
+        for sl in [loader.SuperLoader(), Loader(), Loader(workers=3)]:
+            items = sl.load_many_raw([self.spec, self.spec], requests)
+            self.assertEqual(requests[0], {'obs:obs_id': 'obs2'})
+            self.assertEqual(len(items), len(requests))
+            for request, request_items in zip(requests, items):
+                self.assertEqual(len(request_items), 2)
+                (_, ref), = sl.load_raw([self.spec], dict(request))
+                for _, result in request_items:
+                    self.assertEqual(sorted(result.rows), sorted(ref.rows))
+
+    def test_manifest_cache(self):
+        sl = loader.SuperLoader()
+        sl.manifest_memory_limit = 10**6
+        for i in range(3):
+            (_, result), = sl.load_raw([self.spec], {'obs:obs_id': 'obs0'})
+            self.assertEqual(len(result), 20)
+        self.assertEqual(sl.cache_info(), {'hits': 2, 'misses': 1, 'size': 1})
+        man = sl._open_manifest(self.db)
+        self.assertEqual(man.conn.execute('pragma database_list').fetchone()[2],
+                         '')
+        # Modify the file; the cached copy is discarded.
+        man = proddb.ManifestDB.from_file(self.db)
+        man.add_entry({'obs:obs_id': 'obs9', 'dataset': 'obs0'}, 'f0.h5')
+        man.conn.close()
+        (_, result), = sl.load_raw([self.spec], {'obs:obs_id': 'obs9'})
+        self.assertEqual(len(result), 5)
+        self.assertEqual(sl.cache_info()['misses'], 2)
+        sl.clear_cache()
+        self.assertEqual(sl.cache_info()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -53,6 +53,52 @@ class TestObsFileDB(unittest.TestCase):
                 sorted(db2.get_detsets(obs_id)))
         assert (db.get_detsets('not an obs') == [])
 
+    def test_001_copy(self):
+        db = self.get_simple_db(4, 3)
+        steps = []
+        db2 = db.copy(pages=1, progress=lambda *args: steps.append(args))
+        assert (len(steps) > 1)
+        self.assertEqual(steps[-1][1], 0)  # nothing remaining.
+        self.assertEqual(db.get_file_list(), db2.get_file_list())
+        self.assertEqual(db2.prefix, db.prefix)
+        # Uncommitted changes are copied, too.
+        db.add_obsfile('extra.g3', 'obs0', 'group0', 9000, commit=False)
+        db3 = db.copy()
+        self.assertEqual(len(db3.get_file_list()),
+                         len(db2.get_file_list()) + 1)
+
+    def test_002_get_files(self):
+        db = self.get_simple_db(4, 3)
+        obs_ids = db.get_obs()
+        multi = db.get_files_multi(obs_ids[::-1] + ['not an obs'])
+        self.assertEqual(list(multi.keys()), obs_ids[::-1] + ['not an obs'])
+        for obs_id in obs_ids:
+            self.assertEqual(multi[obs_id], db.get_files(obs_id))
+        self.assertEqual(len(multi['not an obs']), 0)
+        # The temp table insert does not leave a transaction open.
+        assert not db.conn.in_transaction
+        # ... but leaves the caller's transaction open.
+        db.add_obsfile('extra.g3', obs_ids[0], 'group0', 9000, commit=False)
+        db.get_files_multi(obs_ids)
+        assert db.conn.in_transaction
+        db.conn.rollback()
+        multi = db.get_files_multi(obs_ids, detsets=['group1'])
+        self.assertEqual(multi[obs_ids[0]],
+                         db.get_files(obs_ids[0], detsets=['group1']))
+
+        # Cache.
+        db.cache_size = 2
+        for obs_id in obs_ids[:3] + obs_ids[1:3]:
+            db.get_files(obs_id)
+        self.assertEqual(db.cache_info(), {'hits': 2, 'misses': 3, 'size': 2})
+        files = db.get_files(obs_ids[1])
+        db.add_obsfile('extra.g3', obs_ids[1], 'group0', 9000)
+        self.assertEqual(db.cache_info()['size'], 0)
+        self.assertEqual(len(db.get_files(obs_ids[1])['group0']),
+                         len(files['group0']) + 1)
+        db.drop_obs(obs_ids[1])
+        self.assertEqual(len(db.get_files(obs_ids[1])), 0)
+
     def test_010_remove(self):
         db = self.get_simple_db(4, 3)
         n0 = len(db.get_obs())
@@ -85,12 +131,29 @@ class TestObsFileDB(unittest.TestCase):
         os.remove(results['raw'][0][1])
         results2 = db.verify()
         assert(results2['raw'][0][0] is False)
+        _, _, _, obs_id, detset, sample_start = results2['raw'][0]
+        grid = results2['grids'][obs_id]
+        self.assertEqual(grid['grid'].shape, (n_detsets, n_segs))
+        self.assertEqual(grid['grid'].sum(), n_detsets * n_segs - 1)
+        assert not grid['grid'][grid['detset'].index(detset),
+                                grid['sample_start'].index(sample_start)]
+        # Parallel and per-directory checks give the same answer.
+        for kw in [{'workers': 4}, {'by_dir': True},
+                   {'workers': 2, 'by_dir': True}]:
+            counts = []
+            results3 = db.verify(progress=lambda *a: counts.append(a), **kw)
+            self.assertEqual(results3['raw'], results2['raw'])
+            self.assertEqual(counts[-1], (len(results2['raw']),) * 2)
         db2 = db.copy()
         db2.drop_incomplete()
 
         self.assertEqual(db2.get_obs(), db.get_obs())
         self.assertEqual(len(db2.verify()['raw']),
                          len(db.verify()['raw']) - n_segs)
+        # Same, with parallel checks.
+        db3 = db.copy()
+        db3.drop_incomplete(workers=2)
+        self.assertEqual(db3.verify()['raw'], db2.verify()['raw'])
 
     def test_030_prefix(self):
         db = self.get_simple_db()
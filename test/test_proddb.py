@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 
 from sotoddb import proddb
 
@@ -35,6 +36,180 @@ class TestProdDb(unittest.TestCase):
         assert manifest.match({'array': 'pa2',
                                'time': 12000}) is None # Array does not match.
 
+    def test_matcher(self):
+        manifest = self.manifest
+        manifest.add_entry({'array': 'pa3', 'time': (12000., 13000.),
+                            'also_data': 'wafered'}, 'test2')
+        stats = manifest.scheme.matcher_stats
+        for t in [11000, 12000, 12500]:
+            manifest.match({'array': 'pa3', 'time': t})
+        self.assertEqual(stats, {'hits': 2, 'misses': 1})
+        # Extra keys get a new matcher; the result is the same.
+        result = manifest.match({'array': 'pa3', 'time': 12500, 'x': 1})
+        self.assertEqual(result, {'filename': 'test2',
+                                  'also_data': 'wafered'})
+        self.assertEqual(stats, {'hits': 2, 'misses': 2})
+        with self.assertRaises(ValueError):
+            manifest.match({'array': 'pa3'})
+
+    def test_match_many(self):
+        manifest = self.manifest
+        for i, array in enumerate(['pa1', 'pa2', 'pa3']):
+            for t in range(3):
+                manifest.add_entry({'array': array,
+                                    'time': (1000. * t, 1000. * (t + 1)),
+                                    'also_data': 'x%i' % t},
+                                   'file_%i_%i' % (i, t), commit=False)
+        manifest.add_entry({'array': 'pa1', 'time': (500., 1500.),
+                            'also_data': 'extra'}, 'extra')
+        params = [{'array': a, 'time': t} for a in ['pa1', 'pa3', 'pa4']
+                  for t in [-1., 0., 999., 1000., 2500., 3000.]]
+        results = manifest.match_many(params)
+        self.assertEqual(len(results), len(params))
+        for p, r in zip(params, results):
+            self.assertEqual(r, manifest.match(p, multi=True))
+        assert any(len(r) > 1 for r in results)
+        # Structured array input, flat output.
+        arr = np.array([(p['array'], p['time']) for p in params],
+                       dtype=[('array', 'U8'), ('time', float)])
+        flat = manifest.match_many(arr, flat=True)
+        self.assertEqual(flat.keys, ['input_index', 'filename', 'also_data'])
+        self.assertEqual(len(flat), sum(map(len, results)))
+        for row in flat:
+            assert {'filename': row['filename'],
+                    'also_data': row['also_data']} in \
+                results[row['input_index']]
+        with self.assertRaises(ValueError):
+            manifest.match_many([{'array': 'pa1'}])
+        # Inputs are compared with the affinity of the map columns.
+        scheme = proddb.ManifestScheme()
+        scheme.add_exact_match('band', dtype='int')
+        scheme.add_range_match('time')
+        other = proddb.ManifestDB(scheme=scheme)
+        other.add_entry({'band': 1, 'time': (1., 5.)}, 'f')
+        params = [{'band': b, 'time': t} for b in [1, '1', 'x']
+                  for t in [2., 2, '2.0', 6.]]
+        for p, r in zip(params, other.match_many(params)):
+            self.assertEqual(r, other.match(p, multi=True))
+        self.assertEqual(other.match_many(params[:1]), [[{'filename': 'f'}]])
+        # No transaction is left open.
+        assert not manifest.conn.in_transaction
+
+    def test_indexes(self):
+        manifest = self.manifest
+        q = manifest.scheme.get_matcher({'array': 0, 'time': 0}).query
+        plan = [r[-1] for r in manifest.conn.execute(
+            'explain query plan ' + q, ('pa3', 1., 1.))]
+        assert any('idx_map_range_time' in p for p in plan)
+        # Drop them and restore them.
+        manifest.conn.execute('drop index idx_map_range_time')
+        manifest.ensure_indexes()
+        indexes = [r[0] for r in manifest.conn.execute(
+            "select name from sqlite_master where type='index'")]
+        assert 'idx_map_range_time' in indexes
+        assert 'idx_files_name' in indexes
+
+    def test_freeze(self):
+        # Typed columns, and the default (varchar) columns, for which
+        # queries are compared as text.
+        for time_dtype, band_dtype in [('float', 'int'), (None, None)]:
+            kw = {} if time_dtype is None else {'dtype': time_dtype}
+            bkw = {} if band_dtype is None else {'dtype': band_dtype}
+            scheme = proddb.ManifestScheme()
+            scheme.add_exact_match('array')
+            scheme.add_exact_match('band', **bkw)
+            scheme.add_range_match('time', **kw)
+            scheme.add_range_match('el', **kw)
+            scheme.add_data_field('also_data')
+            manifest = proddb.ManifestDB(scheme=scheme)
+            rng = np.random.default_rng(1)
+            for i in range(200):
+                t0, e0 = rng.integers(0, 100, 2)
+                dt, de = rng.integers(1, 20, 2)
+                manifest.add_entry({'array': 'pa%i' % rng.integers(3),
+                                    'band': int(rng.integers(2)),
+                                    'time': (float(t0), float(t0 + dt)),
+                                    'el': (float(e0), float(e0 + de)),
+                                    'also_data': 'x%i' % i},
+                                   'file%i' % (i % 7), commit=False)
+            params = [{'array': 'pa%i' % rng.integers(4),
+                       'band': int(rng.integers(3)),
+                       'time': float(rng.integers(-5, 125)),
+                       'el': float(rng.integers(-5, 125))}
+                      for i in range(500)]
+            # Mixed int / str / float query values.
+            for p in params[::3]:
+                p['band'] = str(p['band'])
+            for p in params[1::3]:
+                p['time'] = int(p['time'])
+            for p in params[2::5]:
+                p['el'] = str(p['el'])
+            params[0]['band'] = 'x'
+            ref = manifest.match_many(params, flat=True)
+            assert len(ref) > 0
+            manifest.freeze()
+            # The frozen manifest doesn't query sqlite.
+            queries = []
+            manifest.conn.set_trace_callback(queries.append)
+            results = manifest.match_many(params, flat=True)
+            self.assertEqual(list(results.rows), list(ref.rows))
+            for p in params[:50]:
+                self.assertEqual(manifest.match(p, multi=True),
+                                 manifest.match_many([p])[0])
+            self.assertEqual(queries, [])
+            manifest.conn.set_trace_callback(None)
+            manifest.thaw()
+            for p in params[:50]:
+                self.assertEqual(manifest.match(p, multi=True),
+                                 manifest.match_many([p])[0])
+        manifest.freeze()
+        with self.assertRaises(RuntimeError):
+            manifest.add_entry(dict(params[0], also_data='x',
+                                    time=(0., 1.), el=(0., 1.)), 'file0')
+        with self.assertRaises(ValueError):
+            manifest.match({'array': 'pa1'})
+        manifest.thaw()
+        self.assertEqual(list(manifest.match_many(params, flat=True).rows),
+                         list(ref.rows))
+        # Empty and single-column cases.
+        self.manifest.freeze()
+        assert self.manifest.match({'array': 'pa3', 'time': 1.}) is None
+        self.manifest.thaw()
+        self.manifest.add_entry({'array': 'pa3', 'time': (0., 2.),
+                                 'also_data': 'x'}, 'file_x')
+        ref = self.manifest.match_many([{'array': 'pa3', 'time': 1.}])
+        assert len(ref[0]) == 1
+        self.manifest.freeze()
+        self.assertEqual(
+            self.manifest.match_many([{'array': 'pa3', 'time': 1.}]), ref)
+
+    def test_freeze_unordered(self):
+        # NULL, and ints mixed with text, in exact columns.
+        scheme = proddb.ManifestScheme()
+        scheme.add_exact_match('array')
+        scheme.add_exact_match('band', dtype='int')
+        scheme.add_range_match('time', dtype='float')
+        manifest = proddb.ManifestDB(scheme=scheme)
+        for i, (array, band) in enumerate([('pa1', 1), (None, 1),
+                                           ('pa1', 'abc'), ('pa2', None)]):
+            manifest.add_entry({'array': array, 'band': band,
+                                'time': (0., 10.)}, 'file%i' % i)
+        params = [{'array': a, 'band': b, 'time': 5.}
+                  for a in ['pa1', 'pa2', None]
+                  for b in [1, '1', 'abc', None, 2]]
+        ref = manifest.match_many(params)
+        manifest.freeze()
+        self.assertEqual(manifest.match_many(params), ref)
+        self.assertEqual(manifest.match_many(params[:3]),
+                         [[{'filename': 'file0'}], [{'filename': 'file0'}],
+                          [{'filename': 'file2'}]])
+        # NULL in a range column can't be frozen.
+        manifest.thaw()
+        manifest.add_entry({'array': 'pa1', 'band': 1, 'time': (None, 1.)},
+                           'file9')
+        with self.assertRaises(ValueError):
+            manifest.freeze()
+
     def test_schema(self):
         print('\nCONSTRUCTED   :', self.scheme.cols)
         print('\nRECONSTRUCTED :', self.manifest.scheme.cols)
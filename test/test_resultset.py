@@ -0,0 +1,194 @@
+import unittest
+import sqlite3
+import numpy as np
+
+from sotoddb import ResultSet
+from sotoddb.resultset import table_dtypes
+
+
+class TestResultSet(unittest.TestCase):
+    def get_rset(self, n=10):
+        rows = [('det%02i' % i, i % 3, i * .5) for i in range(n)]
+        return ResultSet(['name', 'group', 'x'], rows)
+
+    def test_columns(self):
+        rs = self.get_rset()
+        self.assertEqual(len(rs), 10)
+        self.assertEqual(rs['group'].dtype.kind, 'i')
+        self.assertEqual(rs['name'][3], 'det03')
+        # Column access does not copy.
+        assert rs['x'] is rs['x']
+        # Rows are plain python tuples.
+        self.assertEqual(rs.rows[2], ('det02', 2, 1.))
+        self.assertEqual(type(rs.rows[2][1]), int)
+        self.assertEqual(rs[2], {'name': 'det02', 'group': 2, 'x': 1.})
+        self.assertEqual(list(rs.columns.keys()), rs.keys)
+
+    def test_append(self):
+        rs = ResultSet(['a', 'b'])
+        self.assertEqual(len(rs), 0)
+        for i in range(5):
+            rs.append({'a': i, 'b': 'x%i' % i})
+        self.assertEqual(len(rs), 5)
+        np.testing.assert_array_equal(rs['a'], np.arange(5))
+        with self.assertRaises(ValueError):
+            rs.append({'a': 1})
+        # Mixed str and int values are not converted to str.
+        rs = ResultSet(['v'], [(1,), ('x',)])
+        self.assertEqual(list(rs.rows), [(1,), ('x',)])
+        rs.append({'v': 2})
+        self.assertEqual(rs.rows[2], (2,))
+        # Nor are other mixtures, or sequence values.
+        for rows in [[(1,), (2.5,)], [(True,), (2,)], [([1, 2],), ([3],)],
+                     [([1, 2],), ([3, 4],)]]:
+            rs = ResultSet(['v'], rows)
+            self.assertEqual(list(rs.rows), rows)
+            self.assertEqual([type(r[0]) for r in rs.rows],
+                             [type(r[0]) for r in rows])
+        rs = ResultSet(['v'], [(1,)])
+        rs.append({'v': 2.5})
+        self.assertEqual(list(rs.rows), [(1,), (2.5,)])
+
+    def test_subset_slice(self):
+        rs = self.get_rset()
+        sub = rs.subset(keys=['x', 'name'], rows=rs['group'] == 1)
+        self.assertEqual(sub.keys, ['x', 'name'])
+        self.assertEqual(list(sub['name']), ['det01', 'det04', 'det07'])
+        sub = rs.subset(rows=[0, 5])
+        self.assertEqual(list(sub['name']), ['det00', 'det05'])
+        self.assertEqual(len(rs[::2] + rs[1::2]), len(rs))
+        arr = rs.asarray()
+        self.assertEqual(arr.dtype.names, ('name', 'group', 'x'))
+        rs2 = ResultSet.from_friend(arr)
+        self.assertEqual(list(rs2.rows), list(rs.rows))
+
+    def test_merge(self):
+        rs = self.get_rset()
+        other = ResultSet.from_columns({'y': np.arange(len(rs))})
+        rs.merge(other)
+        self.assertEqual(rs.keys, ['name', 'group', 'x', 'y'])
+        self.assertEqual(rs[4]['y'], 4)
+        with self.assertRaises(ValueError):
+            rs.merge(other)
+        with self.assertRaises(ValueError):
+            rs.merge(other[:2])
+
+    def test_restrict_concatenate(self):
+        rs = ResultSet(['dets:band', 'x'],
+                       [('f090', 1.), ('f150', 2.), ('f090', 3.)])
+        sub = rs.restrict_dets({'dets:band': 'f090', 'dets:wafer': 'w1',
+                                'obs:obs_id': 'obs1'})
+        self.assertEqual(sub.keys, ['dets:wafer', 'dets:band', 'x'])
+        self.assertEqual(list(sub.rows), [('w1', 'f090', 1.),
+                                          ('w1', 'f090', 3.)])
+        self.assertEqual(len(rs.restrict_dets({'dets:band': 'f220'})), 0)
+        self.assertEqual(list(rs.restrict_dets({}).rows), list(rs.rows))
+
+        parts = [self.get_rset(n) for n in [3, 0, 5]]
+        rs = ResultSet.concatenate(parts)
+        self.assertEqual(len(rs), 8)
+        self.assertEqual(rs.rows[3], parts[2].rows[0])
+        self.assertEqual(rs['group'].dtype.kind, 'i')
+        rs['x'][0] = -1.
+        self.assertEqual(parts[0]['x'][0], 0.)
+        with self.assertRaises(ValueError):
+            ResultSet.concatenate([parts[0], rs.subset(keys=['x'])])
+
+    def test_distinct(self):
+        rows = [('b', 2, 1.), ('a', 1, 1.), ('b', 2, 1.), ('a', 2, 0.),
+                ('a', 1, 1.), ('b', 2, 1.)]
+        rs = ResultSet(['s', 'i', 'x'], rows)
+        self.assertEqual(list(rs.distinct().rows),
+                         [('b', 2, 1.), ('a', 1, 1.), ('a', 2, 0.)])
+        self.assertEqual(list(rs.distinct(sort=True).rows),
+                         sorted(set(rows)))
+        d, inverse, counts = rs.distinct(return_inverse=True,
+                                         return_counts=True)
+        self.assertEqual([d.rows[i] for i in inverse], rows)
+        self.assertEqual(list(counts), [3, 2, 1])
+        # Unorderable values.
+        rs = ResultSet(['a'], [(None,), (1,), (None,)])
+        self.assertEqual(list(rs.distinct().rows), [(None,), (1,)])
+        self.assertEqual(len(ResultSet(['a']).distinct()), 0)
+
+    def test_groupby(self):
+        rs = self.get_rset()
+        groups, indices = rs.groupby(['group'], sort=True)
+        self.assertEqual(groups.keys, ['group'])
+        self.assertEqual(list(groups['group']), [0, 1, 2])
+        self.assertEqual(list(indices[1]), [1, 4, 7])
+        groups, indices = rs.groupby(['group', 'x'])
+        self.assertEqual(len(groups), 10)
+        self.assertEqual(rs[:0].groupby(['group'])[1], [])
+
+    def test_join(self):
+        props = ResultSet(['name', 'band', 'x'],
+                          [('d0', 'f090', 1.), ('d1', 'f150', 2.),
+                           ('d2', 'f090', 3.)])
+        cal = ResultSet(['name', 'band', 'cal'],
+                        [('d2', 'f090', 20), ('d0', 'f090', 0),
+                         ('d2', 'f090', 21), ('d9', 'f090', 9)])
+        out = props.join(cal, on=['name', 'band'])
+        self.assertEqual(out.keys, ['name', 'band', 'x', 'cal'])
+        self.assertEqual(list(out.rows), [('d0', 'f090', 1., 0),
+                                          ('d2', 'f090', 3., 20),
+                                          ('d2', 'f090', 3., 21)])
+        out = props.join(cal, on='name', how='left')
+        self.assertEqual(out.keys, ['name', 'band_x', 'x', 'band_y', 'cal'])
+        self.assertEqual(len(out), 4)
+        self.assertEqual(out.rows[1][:4], ('d1', 'f150', 2., ''))
+        self.assertIsNone(out.rows[1][4])
+        self.assertEqual(out.rows[3], ('d2', 'f090', 3., 'f090', 21))
+        other = ResultSet.from_columns({'name': ['d1'], 'y': [1.]})
+        out = props.join(other, on='name', how='left')
+        self.assertEqual(len(out), 3)
+        self.assertEqual(np.isnan(out['y']).tolist(), [True, False, True])
+        self.assertEqual(len(props.join(cal[:0], on='name')), 0)
+        with self.assertRaises(ValueError):
+            props.join(cal, on='x')
+        with self.assertRaises(ValueError):
+            props.join(cal, on='name', how='outer')
+        # Larger, random case.
+        rng = np.random.default_rng(0)
+        a = ResultSet.from_columns({'k': rng.integers(0, 500, 2000),
+                                    'i': np.arange(2000)})
+        b = ResultSet.from_columns({'k': rng.integers(0, 500, 1000),
+                                    'j': np.arange(1000)})
+        out = a.join(b, on='k')
+        ref = [(k, i, j) for k, i in a.rows for k2, j in b.rows if k == k2]
+        self.assertEqual(list(out.rows), ref)
+
+    def test_from_cursor(self):
+        conn = sqlite3.connect(':memory:')
+        conn.row_factory = sqlite3.Row
+        conn.execute('create table t (`i` integer, `s` varchar(8), '
+                     '`x` float, `n` numeric, `j` int)')
+        rows = [(i, 's%i' % i, i * .5, i, i) for i in range(25)]
+        rows[21] = (21, None, None, 'text', 2.5)
+        conn.executemany('insert into t values (?,?,?,?,?)', rows)
+        dtypes = table_dtypes(conn, 't')
+        self.assertEqual(dtypes['i'], np.dtype(int))
+        self.assertIsNone(dtypes['n'])
+        rs = ResultSet.from_cursor(conn.execute('select * from t'),
+                                   dtypes=dtypes, chunk_size=4)
+        # Same as inferring the types from all the rows.
+        self.assertEqual(list(rs.rows), list(ResultSet(rs.keys, rows).rows))
+        self.assertEqual(list(rs.rows), rows)
+        self.assertEqual(rs['i'].dtype, np.dtype(int))
+        self.assertEqual(rs['x'].dtype, np.dtype(object))
+        rs = ResultSet.from_cursor(conn.execute('select * from t limit 20'),
+                                   dtypes=dtypes, chunk_size=7)
+        self.assertEqual(rs['x'].dtype, np.dtype(float))
+        self.assertEqual(rs['s'].dtype.kind, 'U')
+        self.assertEqual(rs['j'].dtype.kind, 'i')
+        rs = ResultSet.from_cursor(conn.execute('select s, i from t where 0'),
+                                   keys=['a', 'b'], dtypes=dtypes)
+        self.assertEqual(rs.keys, ['a', 'b'])
+        self.assertEqual(rs['a'].dtype.kind, 'U')
+        self.assertEqual(rs['b'].dtype.kind, 'i')
+        with self.assertRaises(ValueError):
+            ResultSet.from_cursor(conn.execute('select * from t'), keys=['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
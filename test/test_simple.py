@@ -0,0 +1,236 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sotoddb import simple
+
+
+def get_example(n_obs=3, n_dets=5):
+    rows = [('obs%i' % i, 'det%02i' % j, i + j * .1)
+            for i in range(n_obs) for j in range(n_dets)]
+    return simple.PerDetectorHdf5(keys=['obs:obs_id', 'dets:name', 'cal'],
+                                  src=rows)
+
+
+class TestSimple(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.test_dir, 'cal.h5')
+
+    def tearDown(self):
+        simple.dataset_cache.invalidate()
+        shutil.rmtree(self.test_dir)
+
+    def test_cache(self):
+        cache = simple.dataset_cache
+        cache.invalidate()
+        get_example().write_dataset(self.filename, 'cal')
+        info0 = cache.cache_info()
+        req = {'filename': self.filename, 'dataset': 'cal',
+               'obs:obs_id': 'obs1'}
+        for i in range(3):
+            rs = simple.PerDetectorHdf5.from_loadspec(req)
+        self.assertEqual(len(rs), 5)
+        self.assertEqual(list(rs['dets:name'][:2]), ['det00', 'det01'])
+        info = cache.cache_info()
+        self.assertEqual(info['misses'] - info0['misses'], 1)
+        self.assertEqual(info['hits'] - info0['hits'], 2)
+        # Files are not held open, so they can be opened for writing.
+        self.assertEqual(info['files'], 0)
+        assert info['bytes'] > 0
+        with simple.h5py.File(self.filename, 'a'):
+            pass
+        # Rewriting the file closes it and changes the key.
+        get_example(n_dets=3).write_dataset(self.filename, 'cal',
+                                            overwrite=True)
+        self.assertEqual(cache.cache_info()['files'], 0)
+        self.assertEqual(len(simple.PerDetectorHdf5.from_loadspec(req)), 3)
+        cache.invalidate(self.filename)
+        self.assertEqual(cache.cache_info()['datasets'], 0)
+
+        # Size bound.
+        cache = simple.DatasetCache(max_bytes=1000, max_files=0)
+        data = cache.get(self.filename, 'cal')
+        self.assertEqual(cache.cache_info()['datasets'], 1)
+        self.assertEqual(cache.cache_info()['files'], 0)
+        cache.max_bytes = data.nbytes - 1
+        cache.invalidate()
+        self.assertEqual(len(cache.get(self.filename, 'cal')), len(data))
+        self.assertEqual(cache.cache_info()['datasets'], 0)
+
+        # Direct file access.
+        with cache.get_file(self.filename) as fin:
+            self.assertEqual(len(fin['cal']), len(data))
+            self.assertEqual(cache.cache_info()['files'], 1)
+        assert not fin
+        self.assertEqual(cache.cache_info()['files'], 0)
+
+        # Attributes.
+        cache = simple.DatasetCache()
+        for i in range(2):
+            self.assertEqual(cache.get_attr(self.filename, 'cal', 'nope',
+                                            default=5), 5)
+
+        # Held files.
+        cache = simple.DatasetCache(max_files=2)
+        cache.get(self.filename, 'cal')
+        self.assertEqual(cache.cache_info()['files'], 1)
+        cache.invalidate(self.filename)
+        self.assertEqual(cache.cache_info()['files'], 0)
+
+    def test_cache_threads(self):
+        get_example().write_dataset(self.filename, 'cal')
+        get_example().write_dataset(self.filename, 'cal2')
+        cache = simple.DatasetCache()
+        # Both prefilters must be running at once to pass the barrier.
+        barrier = threading.Barrier(2, timeout=10)
+        calls = []
+
+        def prefilter(data):
+            calls.append(1)
+            barrier.wait()
+            return data
+        with ThreadPoolExecutor(4) as pool:
+            jobs = [pool.submit(cache.get, self.filename, d, prefilter)
+                    for d in ['cal', 'cal2']]
+            results = [j.result() for j in jobs]
+        self.assertEqual([len(r) for r in results], [15, 15])
+        # Concurrent requests for one dataset share a single read.
+        barrier = threading.Barrier(1)
+        cache.invalidate()
+        calls.clear()
+        with ThreadPoolExecutor(4) as pool:
+            jobs = [pool.submit(cache.get, self.filename, 'cal', prefilter)
+                    for i in range(8)]
+            results = [j.result() for j in jobs]
+        self.assertEqual(len(calls), 1)
+        assert all(r is results[0] for r in results)
+        self.assertEqual(cache.cache_info()['files'], 0)
+
+    def test_select(self):
+        get_example().write_dataset(self.filename, 'cal')
+        reqs = [{'filename': self.filename, 'dataset': 'cal',
+                 'obs:obs_id': 'obs2'},
+                {'filename': self.filename, 'dataset': 'cal',
+                 'obs:obs_id': 'obs0', 'dets:name': 'det03'},
+                {'filename': self.filename, 'dataset': 'cal',
+                 'obs:obs_id': 'obs9'}]
+        results = simple.PerDetectorHdf5.batch_from_loadspec(reqs)
+        self.assertEqual([len(r) for r in results], [5, 1, 0])
+        assert isinstance(results[0], simple.PerDetectorHdf5)
+        self.assertEqual(results[0].keys, ['dets:name', 'cal'])
+        self.assertEqual(results[1].rows[0], ('det03', 3 * .1))
+        arrays = simple.PerDetectorHdf5.batch_from_loadspec(reqs,
+                                                            as_array=True)
+        self.assertEqual(arrays[0].dtype.names, ('dets:name', 'cal'))
+        for a, r in zip(arrays, results):
+            np.testing.assert_array_equal(a['cal'], r['cal'])
+            self.assertEqual(list(a['dets:name']), list(r['dets:name']))
+
+    def test_decode(self):
+        data = np.array([(b'a', 1), (b'bc', 2)],
+                        dtype=[('dets:name', 'S2'), ('x', int)])
+        out = simple.PerDetectorHdf5._prefilter_data(data)
+        self.assertEqual(out.dtype['dets:name'].char, 'U')
+        self.assertEqual(list(out['dets:name']), ['a', 'bc'])
+        out = simple.PerDetectorHdf5._prefilter_data(data, decode=False)
+        self.assertEqual(out.dtype['dets:name'].char, 'S')
+        with self.assertRaises(UnicodeDecodeError):
+            simple.PerDetectorHdf5._prefilter_data(
+                np.array([b'\xe9'], dtype=[('dets:name', 'S1')]))
+        get_example().write_dataset(self.filename, 'cal')
+        req = {'filename': self.filename, 'dataset': 'cal',
+               'obs:obs_id': 'obs1', 'dets:name': 'det02'}
+        rs = simple.PerDetectorHdf5.from_loadspec(req, decode=False)
+        self.assertEqual(rs.rows[0], (b'det02', 1.2))
+        self.assertEqual(rs['dets:name'].dtype.char, 'S')
+        rs = simple.PerDetectorHdf5.from_loadspec(req)
+        self.assertEqual(rs.rows[0], ('det02', 1.2))
+
+        # Subclasses with the older _prefilter_data signature.
+        class Renamed(simple.PerDetectorHdf5):
+            @classmethod
+            def _prefilter_data(cls, data_in, key_map={'cal': 'gain'}):
+                return super()._prefilter_data(data_in, key_map=key_map)
+        rs = Renamed.from_loadspec(req)
+        self.assertEqual(rs.keys, ['dets:name', 'gain'])
+        self.assertEqual(rs.rows[0], ('det02', 1.2))
+
+    def test_obs_index(self):
+        rs = get_example(n_obs=4)
+        rs = rs.subset(rows=np.random.default_rng(0).permutation(len(rs)))
+        rs.write_dataset(self.filename, 'cal', index_obs=True)
+        with simple.h5py.File(self.filename, 'r') as fin:
+            self.assertEqual(fin['cal'].attrs['obs_index'], 'cal_obs_index')
+            index = fin['cal_obs_index'][()]
+            self.assertEqual(list(index['start']), [0, 5, 10, 15])
+            self.assertEqual(list(fin['cal']['obs:obs_id'][5:10]),
+                             [b'obs1'] * 5)
+        reqs = [{'filename': self.filename, 'dataset': 'cal',
+                 'obs:obs_id': 'obs%i' % i} for i in [2, 0, 7]]
+        ref = get_example(n_obs=4)
+        cache = simple.dataset_cache
+        cache.invalidate()
+        results = simple.PerDetectorHdf5.batch_from_loadspec(reqs)
+        for req, r in zip(reqs, results):
+            sub = ref.subset(rows=ref['obs:obs_id'] == req['obs:obs_id'])
+            self.assertEqual(sorted(r.rows),
+                             sorted(sub.subset(keys=r.keys).rows))
+        # The index and the three row ranges were read and cached.
+        self.assertEqual(cache.cache_info()['datasets'], 4)
+        data = cache.get(self.filename, 'cal', rows=(10, 15))
+        self.assertEqual(list(data['obs:obs_id']), [b'obs2'] * 5)
+        with self.assertRaises(RuntimeError):
+            rs.write_dataset(self.filename, 'cal', index_obs=True)
+        rs.write_dataset(self.filename, 'cal', overwrite=True)
+        with simple.h5py.File(self.filename, 'r') as fin:
+            assert 'cal_obs_index' not in fin
+            assert 'obs_index' not in fin['cal'].attrs
+
+    def test_append(self):
+        full = get_example(n_obs=4)
+        parts = [full.subset(rows=full['obs:obs_id'] == 'obs%i' % i)
+                 for i in range(4)]
+        # Make later rows need wider strings.
+        parts[2] = simple.PerDetectorHdf5(
+            keys=parts[2].keys,
+            src=[('obs2', 'det_long_name', x) for x in parts[2]['cal']])
+        for index_obs in [False, True]:
+            fn = self.filename + str(index_obs)
+            for p in parts[:3]:
+                p.write_dataset(fn, 'cal', append=True, index_obs=index_obs,
+                                compression='gzip')
+            # This one requires re-sorting, if indexed.
+            parts[0].concatenate(parts[:4:3] + parts[1:2]).write_dataset(
+                fn, 'cal', append=True)
+            with simple.h5py.File(fn, 'r') as fin:
+                dset = fin['cal']
+                self.assertEqual(dset.compression, 'gzip')
+                self.assertEqual(dset.maxshape, (None,))
+                self.assertEqual(len(dset), 3 * 5 + 3 * 5)
+                self.assertEqual(dset.dtype['dets:name'].itemsize, 13)
+                if index_obs:
+                    self.assertEqual(dset.attrs['obs_index'],
+                                     'cal_obs_index')
+                    self.assertEqual(list(fin['cal_obs_index']['start']),
+                                     [0, 10, 20, 25])
+            for i in range(4):
+                req = {'filename': fn, 'dataset': 'cal',
+                       'obs:obs_id': 'obs%i' % i}
+                rs = simple.PerDetectorHdf5.from_loadspec(req)
+                self.assertEqual(len(rs), 5 * (2 if i in [0, 1] else 1))
+                self.assertEqual(sorted(rs.rows)[-1],
+                                 sorted(parts[i].subset(keys=rs.keys).rows)[-1])
+        bad = simple.PerDetectorHdf5(keys=['obs:obs_id', 'x'],
+                                     src=[('obs0', 1.)])
+        with self.assertRaises(ValueError):
+            bad.write_dataset(self.filename + 'False', 'cal', append=True)
+
+
+if __name__ == '__main__':
+    unittest.main()